@@ -0,0 +1,213 @@
+#! /usr/bin/env python
+
+
+# This library is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as
+# published by the Free Software Foundation; either version 3 of the
+# License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, see
+# <http://www.gnu.org/licenses/>.
+
+
+"""
+Measures the cost of entering and exiting a scope, for fast locals,
+closure cells, and the globals fallback.
+
+Additional interpreters may be given via --python, in which case this
+script is re-run under each of them and the results are tabulated
+side by side, eg. to compare the Python 2 and Python 3 backends. The
+extension must have been built in-place for every interpreter, eg.
+`python2 setup.py build_ext -i && python3 setup.py build_ext -i`
+
+:author: Christopher O'Brien  <obriencj@gmail.com>
+:license: LGPL v.3
+"""
+
+
+import json
+import sys
+
+from optparse import OptionParser
+from os.path import abspath, dirname
+from subprocess import Popen, PIPE
+from time import time
+
+sys.path.insert(0, dirname(dirname(abspath(__file__))))
+
+from withscope import let
+
+
+def bench_fast(count):
+    a = "tacos"
+    b = "soda"
+    scope = let(a="pizza", b="beer")
+
+    start = time()
+    for _i in range(count):
+        with scope:
+            pass
+    return time() - start
+
+
+def bench_const(count):
+    a = "tacos"
+    b = "soda"
+    scope = let.const(a="pizza", b="beer")
+
+    start = time()
+    for _i in range(count):
+        with scope:
+            pass
+    return time() - start
+
+
+def bench_cells(count):
+    a = "tacos"
+    b = "soda"
+    scope = let(a="pizza", b="beer")
+
+    def closure():
+        return a, b
+
+    start = time()
+    for _i in range(count):
+        with scope:
+            pass
+    return time() - start
+
+
+def bench_globals(count):
+    scope = let(a="pizza", b="beer")
+
+    start = time()
+    for _i in range(count):
+        with scope:
+            pass
+    return time() - start
+
+
+def bench_large(count):
+    # a frame with many locals, only a few of which are bound
+    exec_ns = {"let": let, "time": time}
+    names = ["v%d" % i for i in range(40)]
+    src = "\n".join(
+        ["def large(count):"] +
+        ["    %s = %d" % (name, i) for i, name in enumerate(names)] +
+        ["    scope = let(v1=1, v20=20, v39=39)",
+         "    start = time()",
+         "    for _i in range(count):",
+         "        with scope:",
+         "            pass",
+         "    return time() - start"])
+    exec(compile(src, "<large>", "exec"), exec_ns)
+    return exec_ns["large"](count)
+
+
+def bench_create(count):
+    a = "tacos"
+    b = "soda"
+
+    start = time()
+    for _i in range(count):
+        with let(a="pizza", b="beer"):
+            pass
+    return time() - start
+
+
+def bench_baseline(count):
+    scope = _Nothing()
+
+    start = time()
+    for _i in range(count):
+        with scope:
+            pass
+    return time() - start
+
+
+class _Nothing(object):
+    def __enter__(self):
+        return self
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        return False
+
+
+BENCHMARKS = (
+    ("fast locals", bench_fast),
+    ("const", bench_const),
+    ("closure cells", bench_cells),
+    ("globals", bench_globals),
+    ("large frame", bench_large),
+    ("new scope", bench_create),
+)
+
+
+def run(count, repeat):
+    """
+    returns a dict of benchmark name to the best microseconds per
+    enter/exit, less the cost of a no-op context manager
+    """
+
+    base = min(bench_baseline(count) for _i in range(repeat))
+
+    results = {}
+    for name, func in BENCHMARKS:
+        best = min(func(count) for _i in range(repeat))
+        results[name] = (best - base) * 1e6 / count
+
+    return results
+
+
+def run_under(python, count, repeat):
+    cmd = [python, abspath(__file__), "--json",
+           "--count", str(count), "--repeat", str(repeat)]
+    proc = Popen(cmd, stdout=PIPE)
+    out, _err = proc.communicate()
+    if proc.returncode:
+        sys.exit("benchmark failed under %s" % python)
+    return json.loads(out.decode("utf8"))
+
+
+def main(args=None):
+    parser = OptionParser(usage="%prog [options]")
+    parser.add_option("--count", type="int", default=100000,
+                      help="enter/exit per measurement (default 100000)")
+    parser.add_option("--repeat", type="int", default=5,
+                      help="measurements per benchmark (default 5)")
+    parser.add_option("--python", action="append", default=[],
+                      help="also run under this interpreter (repeatable)")
+    parser.add_option("--json", action="store_true", default=False,
+                      help="emit results as JSON")
+    options, _args = parser.parse_args(args)
+
+    results = run(options.count, options.repeat)
+
+    version = "Python %d.%d" % sys.version_info[:2]
+
+    if options.json:
+        print(json.dumps([version, results]))
+        return
+
+    columns = [(version, results)]
+    for python in options.python:
+        columns.append(run_under(python, options.count, options.repeat))
+
+    print("microseconds per enter/exit")
+    print("%-16s" % "" + "".join("%14s" % c[0] for c in columns))
+    for name, _func in BENCHMARKS:
+        print("%-16s" % name +
+              "".join("%14.3f" % c[1][name] for c in columns))
+
+
+if __name__ == "__main__":
+    main()
+
+
+#
+# The end.
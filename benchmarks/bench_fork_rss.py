@@ -0,0 +1,146 @@
+#! /usr/bin/env python
+
+
+# This library is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as
+# published by the Free Software Foundation; either version 3 of the
+# License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, see
+# <http://www.gnu.org/licenses/>.
+
+
+"""
+Pre-fork memory benchmark: loads a large set of read-only bindings
+into a scope, forks worker processes which each enter that scope,
+and measures how much of the parent's memory each worker ends up
+privately copying, from the Private_Dirty total in /proc/self/smaps.
+
+Compares plain, constant, and frozen scopes, along with a baseline
+of workers which don't enter the scope at all. Linux only.
+
+:author: Christopher O'Brien  <obriencj@gmail.com>
+:license: LGPL v.3
+"""
+
+
+import gc
+import os
+import sys
+
+from optparse import OptionParser
+from os.path import abspath, dirname
+
+sys.path.insert(0, dirname(dirname(abspath(__file__))))
+
+from withscope import let
+
+
+def private_dirty():
+    """
+    the Private_Dirty total of this process, in kB
+    """
+
+    for path in ("/proc/self/smaps_rollup", "/proc/self/smaps"):
+        try:
+            with open(path) as smaps:
+                lines = smaps.readlines()
+        except IOError:
+            continue
+
+        return sum(int(line.split()[1]) for line in lines
+                   if line.startswith("Private_Dirty:"))
+
+    raise SystemExit("this benchmark requires /proc/self/smaps")
+
+
+def make_bindings(count):
+    # distinct objects spread over many pages, standing in for
+    # lookup tables and the like
+    return dict(("v%d" % i, tuple(range(i, i + 16)))
+                for i in range(count))
+
+
+def enter(scope, entries):
+    for _i in range(entries):
+        with scope:
+            pass
+
+
+def fork_worker(scope, entries):
+    """
+    forks a worker which enters scope entries times, and returns the
+    growth in its Private_Dirty total while doing so
+    """
+
+    rfd, wfd = os.pipe()
+
+    pid = os.fork()
+    if not pid:
+        os.close(rfd)
+        try:
+            before = private_dirty()
+            if scope is not None:
+                enter(scope, entries)
+            after = private_dirty()
+            os.write(wfd, str(after - before).encode("ascii"))
+        finally:
+            os._exit(0)
+
+    os.close(wfd)
+    with os.fdopen(rfd) as result:
+        growth = int(result.read())
+    os.waitpid(pid, 0)
+
+    return growth
+
+
+def main(args=None):
+    parser = OptionParser(usage="%prog [options]")
+    parser.add_option("--bindings", type="int", default=20000,
+                      help="bindings in the scope (default 20000)")
+    parser.add_option("--workers", type="int", default=4,
+                      help="workers forked per scope type (default 4)")
+    parser.add_option("--entries", type="int", default=10,
+                      help="times each worker enters the scope"
+                      " (default 10)")
+    options, _args = parser.parse_args(args)
+
+    scopes = (
+        ("baseline", None),
+        ("let", let(make_bindings(options.bindings))),
+        ("const", let.const(make_bindings(options.bindings))),
+        ("frozen", let.frozen(make_bindings(options.bindings))),
+    )
+
+    # keep the collector from touching the parent's objects in the
+    # workers, so that only the scopes' own effects are measured
+    if hasattr(gc, "freeze"):
+        gc.freeze()
+    else:
+        gc.disable()
+
+    print("%d bindings, %d workers, %d entries per worker" %
+          (options.bindings, options.workers, options.entries))
+    print("Private_Dirty growth per worker, in kB")
+
+    for label, scope in scopes:
+        growth = [fork_worker(scope, options.entries)
+                  for _i in range(options.workers)]
+
+        print("%-8s mean: %8.1f  max: %6d" %
+              (label, float(sum(growth)) / len(growth), max(growth)))
+
+
+if __name__ == "__main__":
+    main()
+
+
+#
+# The end.
@@ -0,0 +1,123 @@
+#! /usr/bin/env python
+
+
+# This library is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as
+# published by the Free Software Foundation; either version 3 of the
+# License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, see
+# <http://www.gnu.org/licenses/>.
+
+
+"""
+Startup-time benchmark: generates a module with many top-level
+`with let(...)` blocks, and times importing it.
+
+Run from the project root after building the extension in-place,
+eg.
+`python setup.py build_ext -i && PYTHONPATH=. python benchmarks/bench_module_scopes.py`
+
+:author: Christopher O'Brien  <obriencj@gmail.com>
+:license: LGPL v.3
+"""
+
+
+import sys
+
+from optparse import OptionParser
+from os.path import join
+from shutil import rmtree
+from tempfile import mkdtemp
+from time import time
+
+
+MODULE_NAME = "_bench_module_scopes"
+
+
+BLOCK = """
+with let(host%(i)d="localhost", port%(i)d=%(i)d, debug=False, name="n%(i)d"):
+    config[name] = (host%(i)d, port%(i)d, debug)
+"""
+
+
+def report(label, times, scopes):
+    best = min(times)
+    mean = sum(times) / len(times)
+
+    print("%-8s best: %.3f ms  mean: %.3f ms  per scope: %.2f us" %
+          (label, best * 1e3, mean * 1e3, best * 1e6 / scopes))
+
+
+def generate(path, scopes):
+    lines = ["from withscope import let", "config = {}"]
+    lines.extend(BLOCK % {"i": i} for i in range(scopes))
+
+    with open(join(path, MODULE_NAME + ".py"), "w") as out:
+        out.write("\n".join(lines))
+        out.write("\n")
+
+
+def import_once():
+    sys.modules.pop(MODULE_NAME, None)
+
+    start = time()
+    mod = __import__(MODULE_NAME)
+    elapsed = time() - start
+
+    assert(mod.config)
+    return elapsed
+
+
+def exec_once(code):
+    start = time()
+    exec(code, {"__name__": MODULE_NAME})
+    return time() - start
+
+
+def main(args=None):
+    parser = OptionParser(usage="%prog [options]")
+    parser.add_option("--scopes", type="int", default=500,
+                      help="top-level scopes in the module (default 500)")
+    parser.add_option("--repeat", type="int", default=50,
+                      help="number of timed imports (default 50)")
+    options, _args = parser.parse_args(args)
+
+    path = mkdtemp()
+    sys.path.insert(0, path)
+    try:
+        generate(path, options.scopes)
+
+        # the first import compiles the module, which we don't
+        # want to measure
+        import_once()
+
+        times = [import_once() for _i in range(options.repeat)]
+
+        # the module body alone, without the import machinery and
+        # unmarshalling of the code object
+        with open(join(path, MODULE_NAME + ".py")) as src:
+            code = compile(src.read(), MODULE_NAME, "exec")
+        body_times = [exec_once(code) for _i in range(options.repeat)]
+    finally:
+        sys.path.remove(path)
+        rmtree(path)
+
+    print("%d top-level scopes, %d imports" %
+          (options.scopes, options.repeat))
+    report("import", times, options.scopes)
+    report("body", body_times, options.scopes)
+
+
+if __name__ == "__main__":
+    main()
+
+
+#
+# The end.
@@ -1,4 +1,4 @@
-#! /usr/bin/env python2
+#! /usr/bin/env python
 
 
 # This library is free software; you can redistribute it and/or modify
@@ -37,15 +37,20 @@ TROVE_CLASSIFIERS = (
     "License :: OSI Approved"
     " :: GNU Lesser General Public License v3 or later (LGPLv3+)",
     "Operating System :: OS Independent",
-    "Programming Language :: Python :: 2 :: Only",
+    "Programming Language :: Python :: 2",
     "Programming Language :: Python :: 2.6",
     "Programming Language :: Python :: 2.7",
+    "Programming Language :: Python :: 3",
+    "Programming Language :: Python :: 3.11",
+    "Programming Language :: Python :: 3.12",
+    "Programming Language :: Python :: 3.13",
     "Programming Language :: Python :: Implementation :: CPython",
     "Topic :: Software Development :: Libraries :: Python Modules",
 )
 
 
-ext_frame = Extension("withscope._frame", ["withscope/frame.c"])
+ext_frame = Extension("withscope._frame", ["withscope/frame.c"],
+                      depends = ["withscope/frame_compat.h"])
 
 
 setup(name = "withscope",
@@ -22,15 +22,43 @@ Does some really gross edits to the call frames to accomplish this.
 """
 
 
-__all__ = ("let", "Scope", "ScopeException", "ScopeInUse", "ScopeMismatch")
+__all__ = ("let", "run", "Scope", "ScopeException", "ScopeInUse",
+           "ScopeMismatch", "ScopeConstant")
 
 
 from abc import ABCMeta
 from inspect import currentframe
+from sys import version_info
+
+try:
+    from sys import intern
+except ImportError:
+    pass
 
 from ._frame import (cell_get_value, cell_set_value,
-                     cell_from_value, frame_set_f_globals,
-                     frame_apply_vars, frame_revert_vars)
+                     cell_from_value, cells_update, cells_values,
+                     cells_readback, cells_freeze,
+                     frame_set_f_globals,
+                     frame_apply_vars, frame_revert_vars,
+                     frame_restore_vars, frame_update_vars,
+                     frame_apply_globals, frame_swap_globals,
+                     frame_restore_globals, namespace_apply_cells,
+                     namespace_swap, namespace_restore, frame_site_plan,
+                     code_slot_plan, frame_apply_plan, frame_revert_plan,
+                     frame_restore_plan, frames_apply_plan,
+                     frames_restore_plan)
+
+
+if version_info[0] < 3:
+    _items = dict.iteritems
+else:
+    _items = dict.items
+
+
+def _intern(key):
+    # the extension matches binding names against the names of the
+    # frame's variables by identity, so keep them interned
+    return intern(key) if type(key) is str else key
 
 
 #class nil(object):
@@ -55,9 +83,11 @@ class ScopeException(Exception):
 
 class ScopeInUse(ScopeException):
     """
-    raised when a Scope is entered while already
-    active. `Scope.alias()` can be used to create a duplicate Scope
-    which can be re-used while the original was stil in use
+    raised when a Scope is entered while already active, other than
+    from a frame called by the one it's active in. A Scope may be
+    re-entered by such a frame (eg. by a recursive call), and
+    `Scope.alias()` can be used to create a duplicate Scope which
+    keeps the original's frame in sync.
     """
 
     def __init__(self, scope, frame):
@@ -91,6 +121,48 @@ class ScopeMismatch(ScopeException):
         return self.args[2]
 
 
+class ScopeConstant(ScopeException):
+    """
+    raised when attempting to change the bindings of a constant
+    Scope, as created by `Scope.const(...)`
+    """
+
+    def __init__(self, scope, key):
+        super(ScopeConstant, self).__init__(scope, key)
+
+
+    @property
+    def key(self):
+        return self.args[1]
+
+
+class _ScopeEntry(object):
+    """
+    The saved per-frame state of a Scope which has been re-entered
+    from another frame, kept until the inner entry exits. These are
+    recycled via _entry_pool so that deep recursion through a Scope
+    doesn't allocate.
+    """
+
+    __slots__ = ("frame", "plan", "vars", "cells", "globals", "values")
+
+
+_entry_pool = []
+_ENTRY_POOL_MAX = 256
+
+
+# code flags of generators, coroutines and async generators, whose
+# frames can be suspended while a scope is in-use by them
+_CO_SUSPENDABLE = 0x20 | 0x80 | 0x100 | 0x200
+
+
+# the inline cache of slot plans for each site which enters a scope,
+# see frame_site_plan
+_sites = {}
+_SITES_MAX = 1024
+_SITE_HOT = 8
+
+
 class Scope(object):
     """
     A lexical scope, activated and revoked via the python managed
@@ -106,12 +178,12 @@ class Scope(object):
     >>> from withscope import let
     >>> a = "taco"
     >>> with let(a="pizza", b="beer"):
-    ...     print "%s and %s" % (a, b)
+    ...     print("%s and %s" % (a, b))
     ...
     pizza and beer
-    >>> print a
+    >>> print(a)
     taco
-    >>> print b
+    >>> print(b)
     Traceback (most recent call last):
       File "<stdin>", line 1, in <module>
     NameError: name 'b' is not defined
@@ -121,17 +193,48 @@ class Scope(object):
         #self._defined = dict(*args, **kwds)
         defined = dict(*args, **kwds)
 
-        self._cells = dict((key, cell_from_value(val)) for
-                           key, val in defined.iteritems())
+        self._cells = dict((_intern(key), cell_from_value(val)) for
+                           key, val in _items(defined))
 
+        self._init_state()
+
+
+    def _init_state(self):
         # this is the state we gather at __enter__ and need to restore
-        # at __exit__
+        # at __exit__. If the entering site had a slot plan, then vars
+        # and cells are tuples in the order of the plan, rather than
+        # dicts
         self._outer_frame = None
-        self._outer_locals = None
+        self._outer_plan = None
+        self._outer_vars = None
         self._outer_globals = None
         self._outer_cells = None
-        self._inner_locals = None
-        self._inner_globals = None
+
+        # the values of our bindings as they were when applied to the
+        # frame, kept by child scopes for _readback
+        self._outer_values = None
+
+        # stack of _ScopeEntry for the outer frames when we've been
+        # re-entered. Created on first re-entry and kept thereafter.
+        self._saved = None
+
+        # the records for frames we've been applied to via apply_to,
+        # and for the namespaces of those frames, as kept by
+        # frames_apply_plan. Created on first use.
+        self._applied = None
+        self._applied_ns = None
+
+        # bumped whenever we stop binding a name, start binding a new
+        # one, or bind an existing name to a different cell, but not
+        # when only values change. See _names_version
+        self._version = 0
+
+        # exit policy. When writeback is False, changes made to our
+        # bindings while we're active are discarded rather than read
+        # back out of the frame. When const is True our bindings also
+        # may not be changed via the mapping interface.
+        self._writeback = True
+        self._const = False
 
         # optional Scope instance that we may be an alias of.  TODO:
         # on __exit__ we should propagate our edits to self._defined
@@ -140,6 +243,53 @@ class Scope(object):
         self._alias_parent = None
 
 
+    @classmethod
+    def const(cls, *args, **kwds):
+        """
+        Create a constant scope. Its bindings may not be changed via
+        item assignment or deletion, and any changes made to them
+        while the scope is active (including via closures) are
+        discarded when it exits.
+        """
+
+        scope = cls(*args, **kwds)
+        scope._writeback = False
+        scope._const = True
+        return scope
+
+
+    @classmethod
+    def discard(cls, *args, **kwds):
+        """
+        Create a scope which discards any changes made to its bindings
+        while it is active (including via closures) when it exits. The
+        bindings may still be changed via item assignment.
+        """
+
+        scope = cls(*args, **kwds)
+        scope._writeback = False
+        return scope
+
+
+    @classmethod
+    def frozen(cls, *args, **kwds):
+        """
+        Create a frozen scope, for read-only bindings that are loaded
+        once by a process and then shared with the many processes
+        forked from it. It's a constant scope whose cells and values
+        are also made immortal (under CPython 3.12 and later), so that
+        entering it doesn't write to their reference counts, which
+        would otherwise copy the memory pages holding them into each
+        process. Immortal objects are never freed.
+
+        Under earlier versions a frozen scope is simply constant.
+        """
+
+        scope = cls.const(*args, **kwds)
+        cells_freeze(scope._cells)
+        return scope
+
+
     def alias(self):
         """
         Create an alias scope that can be entered while the original is
@@ -149,45 +299,219 @@ class Scope(object):
 
         dup = self.__new__(type(self))
         dup._cells = self._cells
+        dup._init_state()
 
-        dup._outer_frame = None
-        dup._outer_locals = None
-        dup._outer_globals = None
-        dup._outer_cells = None
-        dup._inner_locals = None
-        dup._inner_globals = None
-
+        dup._writeback = self._writeback
+        dup._const = self._const
         dup._alias_parent = self
 
         return dup
 
 
+    def child(self, *args, **kwds):
+        """
+        Create a child scope, which binds the same names as this scope
+        as well as those specified as parameters, which take
+        precedence. Only the specified bindings are stored in the
+        child. The rest are read through from this scope, including
+        any later changes to them.
+
+        Changes to the child's bindings, whether made via the mapping
+        interface or by a frame that the child is active in, are kept
+        in the child and are never written through to this scope. The
+        child has the same exit policy as this scope.
+        """
+
+        own = dict((_intern(key), cell_from_value(val)) for
+                   key, val in _items(dict(*args, **kwds)))
+
+        child = _ChildScope(self, own)
+        child._writeback = self._writeback
+        child._const = self._const
+        return child
+
+
+    def _bindings_changed(self):
+        """
+        note that the names we bind, or their cells, have changed.
+        Aliases share their bindings, so the version is kept by the
+        original scope.
+        """
+
+        scope = self
+        while scope._alias_parent is not None:
+            scope = scope._alias_parent
+        scope._version += 1
+
+
+    def _names_version(self):
+        """
+        a number which changes whenever the names we bind, or their
+        cells, change
+        """
+
+        scope = self
+        while scope._alias_parent is not None:
+            scope = scope._alias_parent
+        return scope._version
+
+
+    def _released(self):
+        """
+        called once we're no longer in-use, and not applied to any
+        frames
+        """
+
+        pass
+
+
     def __getitem__(self, key):
         cell = self._cells.get(key, None)
         if cell is None:
             raise KeyError(key)
-        return cell_get_value(cell)
+        try:
+            return cell_get_value(cell)
+        except ValueError:
+            # the variable was deleted while the scope is active
+            raise KeyError(key)
 
 
     def __setitem__(self, key, value):
+        if self._const:
+            raise ScopeConstant(self, key)
+
         cell = self._cells.get(key, None)
         if cell is None:
             cell = cell_from_value(value)
-            self._cells[key] = cell
+            self._cells[_intern(key)] = cell
+            self._bindings_changed()
         else:
             cell_set_value(cell, value)
 
 
     def __delitem__(self, key):
+        if self._const:
+            raise ScopeConstant(self, key)
+
         cell = self._cells.pop(key, None)
         if cell is None:
             raise KeyError(key)
 
+        self._bindings_changed()
+
 
     def __contains__(self, key):
         return key in self._cells
 
 
+    def update(self, *args, **kwds):
+        """
+        Set many bindings at once, accepting the same arguments as
+        `dict.update`. If the scope is in-use, the new values are also
+        written directly into the active frame, in a single pass.
+        """
+
+        updates = dict(*args, **kwds)
+        if not updates:
+            return
+
+        if self._const:
+            raise ScopeConstant(self, next(iter(updates)))
+
+        cells = self._cells
+        for key in updates:
+            if key not in cells:
+                self._bindings_changed()
+                break
+
+        frame = self._outer_frame
+        if frame is None:
+            cells_update(cells, updates)
+            return
+
+        self._frame_deopt()
+
+        outer_globals = self._outer_globals
+        if outer_globals is None:
+            outer_globals = {}
+
+        frame_update_vars(frame, cells, updates,
+                          self._outer_vars, self._outer_cells,
+                          outer_globals, nil, not self._writeback)
+
+        if outer_globals:
+            self._outer_globals = outer_globals
+
+
+    def pop(self, key, *default):
+        """
+        Remove a binding and return its value. If the scope is in-use,
+        the active frame's original value for the name is put back,
+        and the value returned is the one the frame held.
+        """
+
+        if self._const:
+            raise ScopeConstant(self, key)
+
+        cell = self._cells.get(key, None)
+        if cell is None:
+            if default:
+                return default[0]
+            raise KeyError(key)
+
+        value = nil
+        if self._outer_frame is not None:
+            value = self._frame_unbind((key, )).get(key, nil)
+            if not self._writeback:
+                value = nil
+
+        if value is nil:
+            value = cell_get_value(cell)
+
+        del self._cells[key]
+        self._bindings_changed()
+
+        return value
+
+
+    def clear(self):
+        """
+        Remove all bindings. If the scope is in-use, the active frame's
+        original values are put back.
+        """
+
+        if self._const and self._cells:
+            raise ScopeConstant(self, next(iter(self._cells)))
+
+        if self._outer_frame is not None:
+            self._frame_unbind(list(self._cells))
+
+        self._cells.clear()
+        self._bindings_changed()
+
+
+    def __getstate__(self):
+        return (self.bindings(), self._writeback, self._const)
+
+
+    def __setstate__(self, state):
+        bindings, writeback, const = state
+        self.__init__(bindings)
+        self._writeback = writeback
+        self._const = const
+
+
+    def bindings(self):
+        """
+        A new dict of this scope's current name to value bindings. If
+        the scope is in-use, the values are first refreshed from the
+        active frame.
+        """
+
+        self._refresh()
+        return cells_values(self._cells)
+
+
     def in_use(self):
         """
         Boolean noting whether this scope is currently in-use
@@ -195,47 +519,120 @@ class Scope(object):
         return self._outer_frame is not None
 
 
+    def apply_to(self, frames):
+        """
+        Apply our bindings to each of frames in a single pass, without
+        entering them. The frames must all belong to the same code
+        object, eg. the frames of many suspended generators created by
+        one generator function. The names are resolved against the
+        frames' slots just once, and the displaced values are kept
+        until `revert_from` is called for those frames.
+
+        Changes to our bindings made after this call aren't pushed
+        into the frames, other than through closure cells. To change
+        the bindings of many frames, revert them, update the scope,
+        and apply it again.
+        """
+
+        frames = tuple(frames)
+        if not frames:
+            return
+
+        for frame in self._active_frames():
+            if frame in frames:
+                raise ScopeInUse(self, frame)
+
+        if self._applied is None:
+            self._applied = {}
+            self._applied_ns = {}
+
+        cells = self._cells
+        plan = code_slot_plan(frames[0].f_code, cells)
+        frames_apply_plan(frames, plan, cells, nil,
+                          not self._writeback,
+                          self._applied, self._applied_ns)
+
+
+    def revert_from(self, frames):
+        """
+        Revert the changes made by `apply_to` for each of frames, which
+        may be all or some of the frames that we were applied to. The
+        values held by the frames are discarded rather than read back
+        into the scope, as there's no single value to keep when many
+        frames have changed the same name.
+        """
+
+        frames = tuple(frames)
+        if not frames:
+            return
+
+        applied = self._applied
+        if not applied:
+            raise ValueError("scope is not applied to frame")
+
+        frames_restore_plan(frames, applied, self._applied_ns, nil)
+
+        if not applied and self._outer_frame is None:
+            self._released()
+
+
+    def _active_frames(self):
+        """
+        the frames that we are currently entered in
+        """
+
+        if self._outer_frame is not None:
+            yield self._outer_frame
+
+        for entry in (self._saved or ()):
+            yield entry.frame
+
+
     def _frame_reapply(self):
         frame = self._outer_frame
         if frame:
-            _unused = frame_apply_vars(frame, self._cells, nil)
+            _unused = frame_apply_vars(frame, self._cells, nil,
+                                       not self._writeback)
 
 
     def _frame_apply(self):
         frame = self._outer_frame
         assert(frame is not None)
 
-        fast, cells = frame_apply_vars(frame, self._cells, nil)
+        # scopes which discard their changes hand out fresh cells, so
+        # that a closure can't write through to ours
+        fresh = not self._writeback
+
+        plan = frame_site_plan(frame, self._cells, _sites,
+                               _SITE_HOT, _SITES_MAX)
+        self._outer_plan = plan
+
+        if plan is not None:
+            fast, cells, outer_globals = frame_apply_plan(frame, plan,
+                                                          self._cells,
+                                                          nil, fresh)
+            self._outer_vars = fast
+            self._outer_cells = cells
+            self._outer_globals = outer_globals
+            return
+
+        fast, cells = frame_apply_vars(frame, self._cells, nil, fresh)
         self._outer_vars = fast
         self._outer_cells = cells
 
-        inner_globals = None
-        outer_globals = None
-
-        # these are all the names we could have bound to
-        # locally. Anything else would require us to use a globals
-        # binding.
-        varnames = set(frame.f_code.co_varnames)
-        varnames.update(frame.f_code.co_cellvars)
-        varnames.update(frame.f_code.co_freevars)
-
-        # construct an inner_globals for bindings that we could not
-        # assign as local variables, cell variables, or free variables
-        for key, val in self._cells.iteritems():
-            if key not in varnames:
-                if inner_globals is None:
-                    inner_globals = {}
-                inner_globals[key] = cell_get_value(val)
-
-        if inner_globals is not None:
-            # if we have found that there are bindings which we
-            # couldn't assign to locally, when we'll have to place
-            # them in the globals for the frame, and keep a record of
-            # the original values to revert the change.
-            outer_globals = frame_swap_globals(frame, inner_globals, nil)
-
-        self._inner_globals = inner_globals
-        self._outer_globals = outer_globals
+        # any bindings that we could not assign as local variables,
+        # cell variables, or free variables have to be placed in the
+        # namespace of the frame instead. We keep a record of the
+        # original values to revert the change. For module-level
+        # frames and class bodies that's the only place they could
+        # go.
+        try:
+            self._outer_globals = frame_apply_globals(frame, self._cells, nil)
+        except:
+            frame_restore_vars(frame, fast, cells, nil)
+            self._outer_vars = None
+            self._outer_cells = None
+            raise
 
 
     def _frame_revert(self):
@@ -244,55 +641,204 @@ class Scope(object):
 
         n = nil
 
+        plan = self._outer_plan
         fast = self._outer_vars
         cells = self._outer_cells
 
-        fast, cells = frame_revert_vars(frame, fast, cells, n)
+        if plan is None:
+            fast, cells = frame_revert_vars(frame, fast, cells, n)
+        else:
+            fast = frame_revert_plan(frame, plan, fast, cells, n)
+
+        values = self._outer_values
 
+        self._outer_plan = None
         self._outer_vars = None
         self._outer_cells = None
+        self._outer_values = None
 
-        for key, val in fast.iteritems():
-            if val is n:
-                del self._cells[key]
-            else:
-                cell_set_value(self._cells[key], val)
-
-        # Python won't actually allow you to delete free or cell vars,
-        # only normal locals.
-        # for key, val in cells.iteritems():
-        #    if val is n:
-        #        del self._cells[key]
+        self._readback(fast, values)
 
-        if self._inner_globals is not None:
+        if self._outer_globals is not None:
             changes = frame_swap_globals(frame, self._outer_globals, n)
-            for key, val in changes.iteritems():
-                if val is n:
-                    del self._cells[key]
-                else:
-                    cell_set_value(self._cells[key], val)
+            self._readback(changes, values)
 
-        self._inner_globals = None
         self._outer_globals = None
 
 
+    def _applied_values(self):
+        """
+        the values to pass to _readback once we've been applied to a
+        frame. Only child scopes need them.
+        """
+
+        return None
+
+
+    def _readback(self, changes, values=None):
+        """
+        store values read back out of a frame into our cells. nil
+        means that the frame deleted the name. Names that we no longer
+        bind (eg. they were popped while we were active) are ignored.
+        values is the dict of our values as they were applied to the
+        frame, if we kept one.
+        """
+
+        if cells_readback(self._cells, changes, nil, None, None):
+            self._bindings_changed()
+
+
+    def _frame_unbind(self, keys):
+        """
+        revert the given names in our active frame to their original
+        values, and stop tracking them. Returns a dict of the values
+        the frame held for those names, with nil for any it had
+        deleted. Names bound via closure cells aren't included, as
+        their values are already in our cells.
+        """
+
+        frame = self._outer_frame
+        assert(frame is not None)
+
+        self._frame_deopt()
+
+        outer_vars = self._outer_vars
+        outer_cells = self._outer_cells
+        outer_globals = self._outer_globals
+
+        revert_vars = {}
+        revert_cells = {}
+        revert_globals = {}
+
+        for key in keys:
+            if key in outer_vars:
+                revert_vars[key] = outer_vars.pop(key)
+            if key in outer_cells:
+                revert_cells[key] = outer_cells.pop(key)
+            if outer_globals and key in outer_globals:
+                revert_globals[key] = outer_globals.pop(key)
+
+        current, _cells = frame_revert_vars(frame, revert_vars,
+                                            revert_cells, nil)
+
+        if revert_globals:
+            current.update(frame_swap_globals(frame, revert_globals, nil))
+            if not outer_globals:
+                self._outer_globals = None
+
+        return current
+
+
+    def _frame_deopt(self):
+        """
+        convert the state of the active entry from the compact form
+        used with a slot plan to the dicts used by the generic path,
+        so that it can be modified
+        """
+
+        plan = self._outer_plan
+        if plan is None:
+            return
+
+        vslots, cslots, _gkeys = plan
+
+        self._outer_vars = dict((key, val) for (_i, key), val in
+                                zip(vslots, self._outer_vars))
+        self._outer_cells = dict((key, val) for (_i, key), val in
+                                 zip(cslots, self._outer_cells))
+        self._outer_plan = None
+
+
+    def _push_entry(self):
+        """
+        save the state of the active entry so that we can be entered
+        again from another frame
+        """
+
+        try:
+            entry = _entry_pool.pop()
+        except IndexError:
+            entry = _ScopeEntry()
+
+        entry.frame = self._outer_frame
+        entry.plan = self._outer_plan
+        entry.vars = self._outer_vars
+        entry.cells = self._outer_cells
+        entry.globals = self._outer_globals
+        entry.values = self._outer_values
+
+        saved = self._saved
+        if saved is None:
+            saved = self._saved = []
+        saved.append(entry)
+
+
+    def _pop_entry(self):
+        """
+        restore the state of the most recently saved entry, making it
+        active again
+        """
+
+        entry = self._saved.pop()
+
+        self._outer_frame = entry.frame
+        self._outer_plan = entry.plan
+        self._outer_vars = entry.vars
+        self._outer_cells = entry.cells
+        self._outer_globals = entry.globals
+        self._outer_values = entry.values
+
+        entry.frame = entry.plan = None
+        entry.vars = entry.cells = entry.globals = entry.values = None
+        if len(_entry_pool) < _ENTRY_POOL_MAX:
+            _entry_pool.append(entry)
+
+
+    def _frame_restore(self):
+        """
+        the exit path for scopes which discard their changes. The
+        frame's original values are put back, and nothing is read
+        back out of it.
+        """
+
+        frame = self._outer_frame
+        assert(frame is not None)
+
+        plan = self._outer_plan
+        if plan is None:
+            frame_restore_vars(frame, self._outer_vars,
+                               self._outer_cells, nil)
+        else:
+            frame_restore_plan(frame, plan, self._outer_vars,
+                               self._outer_cells, nil)
+
+        self._outer_plan = None
+        self._outer_vars = None
+        self._outer_cells = None
+        self._outer_values = None
+
+        if self._outer_globals is not None:
+            frame_restore_globals(frame, self._outer_globals, nil)
+            self._outer_globals = None
+
+
     def _refresh(self):
         """
         refresh the values of our defined cells from the fast vars in our
         frame, if any. This happens automatically when the scope exits
-        as well.
+        as well. Scopes which discard their changes are never
+        refreshed.
         """
 
-        if not self._outer_frame:
+        if not (self._outer_frame and self._writeback):
             return
 
         # TODO: make a more direct version of this, that works with
         # deleted vars and only looks through fast vars (cell and free
         # vars are always up-to-date)
         l = self._outer_frame.f_locals
-        for key, val in l.iteritems():
-            if key in self._cells:
-                cell_set_value(self._cells[key], val)
+        self._readback(dict((key, l[key]) for key in self._cells
+                            if key in l), self._outer_values)
 
 
     def __enter__(self):
@@ -300,14 +846,34 @@ class Scope(object):
         Push our bindings, by hacking at the calling frame's locals,
         globals, and fast var cells. We are considered in-use until
         __exit__ is called.
+
+        If we are already in-use by a frame which (directly or
+        indirectly) called the calling frame, that frame's state is
+        saved and we are applied to the calling frame as well. The
+        calling frame sees our bindings as they were when last
+        written back, which does not include changes the other frame
+        has made and not yet exited with. Use an alias if the frames
+        need to be kept in sync. Entering from any other frame, such
+        as another thread, or from a generator or coroutine (which
+        could be suspended and resumed elsewhere) raises ScopeInUse,
+        since it couldn't be relied upon to exit in the reverse order.
         """
 
         #print "__enter__ for %08x" % id(self)
 
-        if self._outer_frame:
-            raise ScopeInUse(self, self._outer_frame)
-
         caller = currentframe().f_back
+
+        outer = self._outer_frame
+        if outer:
+            if caller.f_code.co_flags & _CO_SUSPENDABLE:
+                raise ScopeInUse(self, caller)
+            frame = caller.f_back
+            while frame is not None and frame is not outer:
+                frame = frame.f_back
+            if frame is None:
+                raise ScopeInUse(self, caller)
+            self._push_entry()
+
         self._outer_frame = caller
 
         # ensure our defined values are up-to-date from the parent
@@ -316,7 +882,19 @@ class Scope(object):
         if parent:
             parent._refresh()
 
-        self._frame_apply()
+        try:
+            self._frame_apply()
+        except:
+            # the frame is left as it was, so we aren't in-use by it
+            self._outer_plan = None
+            self._outer_values = None
+            if self._saved:
+                self._pop_entry()
+            else:
+                self._outer_frame = None
+                if not self._applied:
+                    self._released()
+            raise
 
         return self
 
@@ -325,6 +903,10 @@ class Scope(object):
         """
         Pop our bindings, and we are no longer considered to be
         in-use. Also syncs the scope variables to any parent aliases.
+
+        If we had been re-entered, the outer frame's entry becomes the
+        active one again. Entries must be exited in the reverse order
+        that they were entered.
         """
 
         #print "__exit__ for %08x" % id(self)
@@ -339,8 +921,17 @@ class Scope(object):
         if parent:
             parent._refresh()
 
-        self._frame_revert()
-        self._outer_frame = None
+        if self._writeback:
+            self._frame_revert()
+        else:
+            self._frame_restore()
+
+        if self._saved:
+            self._pop_entry()
+        else:
+            self._outer_frame = None
+            if not self._applied:
+                self._released()
 
         # if we are an alias, we have to now tell the parent
         # that we've updated the shared defined dict, and have it
@@ -355,31 +946,265 @@ class Scope(object):
 let = Scope
 
 
-def frame_swap_globals(frame, updates, nil):
-    # TODO: move this into frame.c
+class _ChildScope(Scope):
+    """
+    A Scope created via `Scope.child`. Only its own bindings are
+    stored, in _own, where nil marks a name that the child has
+    stopped binding. Everything else is read through from the parent.
+
+    The parent's cells are shared rather than copied. A name is
+    copied into the child when it's written, and also before it's
+    placed into a cell slot, as otherwise a closure could write
+    through to the parent. _cells is the flattened view of the
+    bindings that the rest of Scope works with. It's only kept while
+    the child is in-use (or applied to frames), and is rebuilt if the
+    names bound by the child or any of its ancestors change.
+    """
 
-    assert(frame is not None)
+    def __init__(self, parent, own):
+        self._parent = parent
+        self._own = own
 
-    glbls = frame.f_globals
-    lcls = frame.f_locals
-    originals = {}
+        self._flat = None
+        self._flat_version = None
 
-    for key, val in updates.iteritems():
-        if key in glbls:
-            originals[key] = glbls[key]
-            if val is nil:
-                del glbls[key]
-                lcls.pop(key, None)
-            else:
-                glbls[key] = val
-                lcls[key] = val
+        # the code object and version of the last _own_cell_slots
+        self._slots_code = None
+        self._slots_version = None
+
+        self._init_state()
+
+
+    @property
+    def _cells(self):
+        version = self._names_version()
+
+        cells = self._flat
+        if cells is None or self._flat_version != version:
+            cells = dict(self._parent._cells)
+            for key, cell in _items(self._own):
+                if cell is nil:
+                    cells.pop(key, None)
+                else:
+                    cells[key] = cell
+
+            if self._outer_frame is not None or self._applied:
+                self._flat = cells
+                self._flat_version = version
+
+        return cells
+
+
+    def _names_version(self):
+        # versions only ever increase, so the sum changes whenever
+        # any of them do
+        return (super(_ChildScope, self)._names_version() +
+                self._parent._names_version())
+
+
+    def _released(self):
+        self._flat = None
+        self._flat_version = None
+
+
+    def alias(self):
+        dup = _ChildScope(self._parent, self._own)
+
+        dup._writeback = self._writeback
+        dup._const = self._const
+        dup._alias_parent = self
+
+        return dup
+
+
+    def __reduce__(self):
+        # the parent isn't pickled along with us, so we go as a flat
+        # Scope of our current bindings
+        return (Scope, (), self.__getstate__())
+
+
+    def __getitem__(self, key):
+        cell = self._own.get(key, None)
+        if cell is None:
+            return self._parent[key]
+        elif cell is nil:
+            raise KeyError(key)
+
+        try:
+            return cell_get_value(cell)
+        except ValueError:
+            # the variable was deleted while the scope is active
+            raise KeyError(key)
+
+
+    def __setitem__(self, key, value):
+        if self._const:
+            raise ScopeConstant(self, key)
+
+        cell = self._own.get(key, None)
+        if cell is None or cell is nil:
+            self._own[_intern(key)] = cell_from_value(value)
+            self._bindings_changed()
         else:
-            originals[key] = nil
-            if val is not nil:
-                glbls[key] = val
-                lcls[key] = val
+            cell_set_value(cell, value)
+
+
+    def __delitem__(self, key):
+        if self._const:
+            raise ScopeConstant(self, key)
+
+        if key not in self:
+            raise KeyError(key)
+
+        self._own[_intern(key)] = nil
+        self._bindings_changed()
+
+
+    def __contains__(self, key):
+        cell = self._own.get(key, None)
+        if cell is None:
+            return key in self._parent
+        return cell is not nil
+
+
+    def update(self, *args, **kwds):
+        updates = dict(*args, **kwds)
+
+        if updates and not self._const:
+            own = self._own
+            copied = False
+
+            for key, val in _items(updates):
+                cell = own.get(key, None)
+                if cell is None or cell is nil:
+                    own[_intern(key)] = cell_from_value(val)
+                    copied = True
+
+            if copied:
+                self._bindings_changed()
+
+            # every name being updated is now one of our own, so
+            # there's no need to flatten the view just to set them
+            if self._outer_frame is None:
+                cells_update(own, updates)
+                return
 
-    return originals
+        super(_ChildScope, self).update(updates)
+
+
+    def pop(self, key, *default):
+        bound = key in self
+        value = super(_ChildScope, self).pop(key, *default)
+
+        if bound:
+            self._own[key] = nil
+            self._bindings_changed()
+
+        return value
+
+
+    def clear(self):
+        keys = list(self._cells)
+        super(_ChildScope, self).clear()
+
+        own = self._own
+        for key in keys:
+            own[key] = nil
+        self._bindings_changed()
+
+
+    def apply_to(self, frames):
+        frames = tuple(frames)
+        if frames:
+            self._own_cell_slots(frames[0].f_code)
+
+        super(_ChildScope, self).apply_to(frames)
+
+
+    def _frame_apply(self):
+        self._own_cell_slots(self._outer_frame.f_code)
+        super(_ChildScope, self)._frame_apply()
+        self._outer_values = self._applied_values()
+
+
+    def _applied_values(self):
+        # a name the frame left alone is still read through from the
+        # parent, even if the parent changes it while we're active
+        return cells_values(self._cells)
+
+
+    def _own_cell_slots(self, code):
+        """
+        copy the bindings that will be placed into cell or free var
+        slots of code into the child. Not needed if we discard our
+        changes, as then the frame is given fresh cells anyway.
+        """
+
+        if not self._writeback:
+            return
+
+        version = self._names_version()
+        if code is self._slots_code and self._slots_version == version:
+            return
+
+        own = self._own
+        parent = self._parent
+        changed = False
+
+        for key in code.co_cellvars + code.co_freevars:
+            if key not in own and key in parent:
+                own[key] = cell_from_value(parent[key])
+                changed = True
+
+        if changed:
+            self._bindings_changed()
+            version = self._names_version()
+
+        self._slots_code = code
+        self._slots_version = version
+
+
+    def _readback(self, changes, values=None):
+        if cells_readback(self._cells, changes, nil, self._own, values):
+            self._bindings_changed()
+
+
+def run(code, scope, globals=None):
+    """
+    Evaluates code, a code object as returned from `compile` in either
+    "exec" or "eval" mode, with the bindings of scope applied. Returns
+    the value of the expression for "eval" mode code, or None.
+
+    The bindings are swapped directly into the globals dict for the
+    duration of the call, and the original values put back
+    afterwards, just as a `with let(...)` block at the top level of a
+    module would. The cost of each call therefore depends on the
+    number of bindings, not on the size of globals, so the same
+    globals can be prepared once and reused for many calls. If
+    globals is not specified, a new empty namespace is used.
+
+    As with the module level, assignments to bound names are read
+    back into the scope (unless its policy discards them), and any
+    other names assigned by code remain in globals.
+    """
+
+    if globals is None:
+        globals = {}
+
+    cells = scope._cells
+    values = scope._applied_values()
+    originals = namespace_apply_cells(globals, cells, nil)
+
+    try:
+        return eval(code, globals)
+
+    finally:
+        if originals is not None:
+            if scope._writeback:
+                scope._readback(namespace_swap(globals, originals, nil),
+                                values)
+            else:
+                namespace_restore(globals, originals, nil)
 
 
 #
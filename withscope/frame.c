@@ -29,9 +29,7 @@
 */
 
 
-#include <Python.h>
-#include <cellobject.h>
-#include <frameobject.h>
+#include "frame_compat.h"
 
 
 static PyObject *cell_from_value(PyObject *self, PyObject *args) {
@@ -50,6 +48,11 @@ static PyObject *cell_get_value(PyObject *self, PyObject *args) {
   if (! PyArg_ParseTuple(args, "O!", &PyCell_Type, &cell))
     return NULL;
 
+  if (! PyCell_GET(cell)) {
+    PyErr_SetString(PyExc_ValueError, "empty cell");
+    return NULL;
+  }
+
   return PyCell_Get(cell);
 }
 
@@ -77,114 +80,340 @@ static PyObject *frame_set_f_globals(PyObject *self, PyObject *args) {
   if (! PyArg_ParseTuple(args, "O!O", &PyFrame_Type, &frame, &val))
     return NULL;
 
+#if PY_MAJOR_VERSION >= 3
+  // the interpreter frame only borrows its globals from the
+  // function, so there's nothing that could keep val alive
+  PyErr_SetString(PyExc_NotImplementedError,
+		  "frame globals cannot be replaced under Python 3");
+  return NULL;
+
+#else
   PyObject *old_globals = frame->f_globals;
   frame->f_globals = val;
   Py_INCREF(val);
   Py_DECREF(old_globals);
 
   Py_RETURN_NONE;
+#endif
 }
 
 
 /**
-   From the dict newcells, find cells in fast (named by their index in
-   vars) that match, and replace the fast reference with the
-   newcells[name] reference. Record swaps in the swapped dict.
+   The namespace dict that bindings which cannot be placed into fast
+   or cell slots must be swapped into. For module-level frames the
+   locals are the globals, and for class bodies (and other
+   unoptimized code) names are loaded from the locals before falling
+   through to the globals, so in both cases a single swap in f_locals
+   suffices. Function frames need their globals swapped, and if the
+   locals dict has already been materialized it is returned via
+   mirror so that it can be kept in step.
  */
-static inline void
-fast_cells_swap(PyObject **fast, int offset, PyObject *vars,
-		PyObject *newcells, PyObject *swapped) {
+static PyObject *frame_namespace(PyFrameObject *frame, PyObject **mirror) {
+  PyObject *locals = frame_locals(frame);
 
-  PyObject *key, *newcell, *oldcell;
-  int count = PyTuple_GET_SIZE(vars);
-  int index;
+  *mirror = NULL;
 
-  while (count-- ) {
-    key = PyTuple_GET_ITEM(vars, count);
-    newcell = PyObject_GetItem(newcells, key);
+  if ((frame_code(frame)->co_flags & CO_OPTIMIZED) || ! locals) {
+    if (locals != frame_globals(frame))
+      *mirror = locals;
+    return frame_globals(frame);
 
-    if (newcell) {
-      index = offset + count;
-      oldcell = fast[index];
-      fast[index] = newcell;
+  } else {
+    return locals;
+  }
+}
 
-      PyObject_SetItem(swapped, key, oldcell);
-      Py_DECREF(oldcell);
 
-    } else {
+/**
+   Swaps val into ns under key, recording the displaced value (or nil
+   if there was none) in originals, unless originals is NULL. A val
+   of nil removes the key. Returns -1 with an exception set on
+   failure.
+ */
+static int ns_swap(PyObject *ns, PyObject *mirror, PyObject *key,
+		   PyObject *val, PyObject *nil, PyObject *originals) {
+
+  PyObject *old;
+  int ret;
+
+  if (PyDict_CheckExact(ns)) {
+    old = PyDict_GetItem(ns, key);
+    Py_XINCREF(old);
+
+  } else {
+    old = PyObject_GetItem(ns, key);
+    if (! old) {
+      if (! PyErr_ExceptionMatches(PyExc_KeyError))
+	return -1;
       PyErr_Clear();
     }
   }
+
+  ret = originals? PyDict_SetItem(originals, key, old? old: nil): 0;
+
+  if (! ret) {
+    if (val != nil) {
+      ret = PyObject_SetItem(ns, key, val);
+    } else if (old) {
+      ret = PyObject_DelItem(ns, key);
+    }
+  }
+
+  Py_XDECREF(old);
+
+  if (! ret && mirror) {
+    if (val != nil) {
+      ret = PyObject_SetItem(mirror, key, val);
+    } else if (PyObject_DelItem(mirror, key)) {
+      if (PyErr_ExceptionMatches(PyExc_KeyError)) {
+	PyErr_Clear();
+      } else {
+	ret = -1;
+      }
+    }
+  }
+
+  return ret;
 }
 
 
-static PyObject *frame_revert_vars(PyObject *self, PyObject *args) {
+/**
+   Puts the values in originals back into ns (and mirror) after a
+   failed swap, keeping the exception which is already set
+ */
+static void ns_unswap(PyObject *ns, PyObject *mirror, PyObject *originals,
+		      PyObject *nil) {
+
+  PyObject *exc, *exc_val, *exc_tb, *key, *val;
+  Py_ssize_t pos = 0;
+
+  PyErr_Fetch(&exc, &exc_val, &exc_tb);
+
+  while (PyDict_Next(originals, &pos, &key, &val)) {
+    if (ns_swap(ns, mirror, key, val, nil, NULL))
+      PyErr_Clear();
+  }
+
+  PyErr_Restore(exc, exc_val, exc_tb);
+}
+
+
+/**
+   Swaps each of the values in updates into ns, recording the values
+   displaced in originals, unless originals is NULL. If a swap fails
+   the recorded values are put back.
+ */
+static int swap_values(PyObject *ns, PyObject *mirror, PyObject *updates,
+		       PyObject *nil, PyObject *originals) {
+
+  PyObject *key, *val;
+  Py_ssize_t pos = 0;
+
+  while (PyDict_Next(updates, &pos, &key, &val)) {
+    if (ns_swap(ns, mirror, key, val, nil, originals)) {
+      if (originals)
+	ns_unswap(ns, mirror, originals, nil);
+      return -1;
+    }
+  }
+
+  return 0;
+}
+
+
+/**
+   Swaps the values in updates into the namespace of frame, returning
+   a dict of the values they displaced. nil as a value in updates
+   indicates the name should be removed, and nil in the returned dict
+   indicates the name was previously unset.
+ */
+static PyObject *frame_swap_globals(PyObject *self, PyObject *args) {
   PyFrameObject *frame = NULL;
-  PyObject *revert_vars, *revert_cells;
+  PyObject *updates = NULL;
   PyObject *nil = NULL;
 
-  if (! PyArg_ParseTuple(args, "O!O!O!O",
+  if (! PyArg_ParseTuple(args, "O!O!O",
 			 &PyFrame_Type, &frame,
-			 &PyDict_Type, &revert_vars,
-			 &PyDict_Type, &revert_cells,
+			 &PyDict_Type, &updates,
 			 &nil))
     return NULL;
 
-  PyCodeObject *code = frame->f_code;
-  PyObject **fast = frame->f_localsplus;
-  PyObject *key, *newval, *oldval;
-  int i, offset;
+  PyObject *ns, *mirror;
 
-  PyObject *ret = PyTuple_New(2);
-  PyObject *o_vars, *o_cells;
+  PyObject *originals = PyDict_New();
+  if (! originals)
+    return NULL;
 
-  o_vars = PyDict_New();
-  o_cells = PyDict_New();
+  ns = frame_namespace(frame, &mirror);
 
-  PyTuple_SET_ITEM(ret, 0, o_vars);
-  PyTuple_SET_ITEM(ret, 1, o_cells);
+  if (swap_values(ns, mirror, updates, nil, originals)) {
+    Py_DECREF(originals);
+    return NULL;
+  }
 
-  // first we go through locals, and if we find a var matching a
-  // defined name, we swap our value in and store the original in a
-  // dictionary so we can restore it later. The scope stores all its
-  // values wrapped in cells
-  for (i = code->co_nlocals; i--; ) {
-    key = PyTuple_GET_ITEM(code->co_varnames, i);
-    newval = PyObject_GetItem(revert_vars, key);
-
-    if (newval) {
-      oldval = fast[i];
-      if (newval == nil) {
-	// nil is our sentinel value meaning that a var should be
-	// cleared
-	fast[i] = NULL;
-	Py_DECREF(newval);
-      } else {
-	fast[i] = newval;
-      }
+  return originals;
+}
 
-      // nil used again here, if the var was previously unset, the
-      // value is NULL, so we'll denote that by putting nil in its
-      // place in the returned dict.
-      PyObject_SetItem(o_vars, key, oldval? oldval: nil);
-      Py_XDECREF(oldval);
 
-    } else {
-      PyErr_Clear();
+/**
+   Restores the values in originals (as returned from
+   frame_swap_globals or frame_apply_globals) into the namespace of
+   frame, discarding the values they replace.
+ */
+static PyObject *frame_restore_globals(PyObject *self, PyObject *args) {
+  PyFrameObject *frame = NULL;
+  PyObject *originals = NULL;
+  PyObject *nil = NULL;
+
+  if (! PyArg_ParseTuple(args, "O!O!O",
+			 &PyFrame_Type, &frame,
+			 &PyDict_Type, &originals,
+			 &nil))
+    return NULL;
+
+  PyObject *ns, *mirror;
+
+  ns = frame_namespace(frame, &mirror);
+
+  if (swap_values(ns, mirror, originals, nil, NULL))
+    return NULL;
+
+  Py_RETURN_NONE;
+}
+
+
+/**
+   As frame_swap_globals, but swaps directly into the dict ns rather
+   than into the namespace of a frame
+ */
+static PyObject *namespace_swap(PyObject *self, PyObject *args) {
+  PyObject *ns = NULL;
+  PyObject *updates = NULL;
+  PyObject *nil = NULL;
+
+  if (! PyArg_ParseTuple(args, "O!O!O",
+			 &PyDict_Type, &ns,
+			 &PyDict_Type, &updates,
+			 &nil))
+    return NULL;
+
+  PyObject *originals = PyDict_New();
+  if (! originals)
+    return NULL;
+
+  if (swap_values(ns, NULL, updates, nil, originals)) {
+    Py_DECREF(originals);
+    return NULL;
+  }
+
+  return originals;
+}
+
+
+/**
+   As frame_restore_globals, but restores directly into the dict ns
+   rather than into the namespace of a frame
+ */
+static PyObject *namespace_restore(PyObject *self, PyObject *args) {
+  PyObject *ns = NULL;
+  PyObject *originals = NULL;
+  PyObject *nil = NULL;
+
+  if (! PyArg_ParseTuple(args, "O!O!O",
+			 &PyDict_Type, &ns,
+			 &PyDict_Type, &originals,
+			 &nil))
+    return NULL;
+
+  if (swap_values(ns, NULL, originals, nil, NULL))
+    return NULL;
+
+  Py_RETURN_NONE;
+}
+
+
+/**
+   True if key names a local, cell, or free variable of code. Slot
+   names are interned, and so are the keys of a Scope, so they are
+   compared by identity. A key that was not interned is exchanged for
+   its interned equivalent first.
+ */
+static int code_has_slot(PyCodeObject *code, PyObject *key) {
+  Py_ssize_t i, count = code_nslots(code);
+  int found = 0;
+
+  Py_INCREF(key);
+  if (name_is_uninterned(key))
+    name_intern(&key);
+
+  for (i = 0; i < count; i++) {
+    if (code_slot_name(code, i) == key) {
+      found = 1;
+      break;
     }
   }
 
-  offset = code->co_nlocals;
-  fast_cells_swap(fast, offset, code->co_cellvars, revert_cells, o_cells);
+  Py_DECREF(key);
+  return found;
+}
 
-  offset += PyTuple_GET_SIZE(code->co_cellvars);
-  fast_cells_swap(fast, offset, code->co_freevars, revert_cells, o_cells);
 
-  return ret;
+/**
+   Swaps the value of each cell in the dict scopecells into ns,
+   skipping those which name a slot of code, if code is not NULL.
+   Returns a dict of the displaced values, or None if nothing was
+   swapped.
+ */
+static PyObject *apply_cells(PyObject *ns, PyObject *mirror,
+			     PyObject *scopecells, PyCodeObject *code,
+			     PyObject *nil) {
+
+  PyObject *key, *cell, *val;
+  PyObject *originals = NULL;
+  Py_ssize_t pos = 0;
+  int err;
+
+  while (PyDict_Next(scopecells, &pos, &key, &cell)) {
+    if (code && code_has_slot(code, key))
+      continue;
+
+    if (! originals) {
+      originals = PyDict_New();
+      if (! originals)
+	return NULL;
+    }
+
+    val = PyCell_GET(cell);
+    if (! val) {
+      PyErr_SetString(PyExc_ValueError, "empty cell in scope");
+      err = -1;
+    } else {
+      err = ns_swap(ns, mirror, key, val, nil, originals);
+    }
+
+    if (err) {
+      ns_unswap(ns, mirror, originals, nil);
+      Py_DECREF(originals);
+      return NULL;
+    }
+  }
+
+  if (originals) {
+    return originals;
+  } else {
+    Py_RETURN_NONE;
+  }
 }
 
 
-static PyObject *frame_apply_vars(PyObject *self, PyObject *args) {
+/**
+   For each binding in the dict scopecells which could not be applied
+   by frame_apply_vars (because code has no slot by that name), swaps
+   the binding's value into the namespace of frame. Returns a dict of
+   the displaced values suitable for passing to frame_swap_globals to
+   revert the change, or None if no bindings needed swapping.
+ */
+static PyObject *frame_apply_globals(PyObject *self, PyObject *args) {
   PyFrameObject *frame = NULL;
   PyObject *scopecells = NULL;
   PyObject *nil = NULL;
@@ -195,79 +424,1663 @@ static PyObject *frame_apply_vars(PyObject *self, PyObject *args) {
 			 &nil))
     return NULL;
 
-  PyCodeObject *code = frame->f_code;
-  PyObject **fast = frame->f_localsplus;
-  PyObject *key, *newcell, *oldval;
-  int i, offset;
+  PyCodeObject *code = frame_code(frame);
+  PyObject *ns, *mirror;
 
-  PyObject *o_vars, *o_cells;
+  ns = frame_namespace(frame, &mirror);
+
+  // module and class body frames have no local slots, so there's no
+  // need to check
+  if (! (code->co_flags & CO_OPTIMIZED))
+    code = NULL;
+
+  return apply_cells(ns, mirror, scopecells, code, nil);
+}
+
+
+/**
+   As frame_apply_globals, but swaps every binding directly into the
+   dict ns rather than into the namespace of a frame
+ */
+static PyObject *namespace_apply_cells(PyObject *self, PyObject *args) {
+  PyObject *ns = NULL;
+  PyObject *scopecells = NULL;
+  PyObject *nil = NULL;
+
+  if (! PyArg_ParseTuple(args, "O!O!O",
+			 &PyDict_Type, &ns,
+			 &PyDict_Type, &scopecells,
+			 &nil))
+    return NULL;
+
+  return apply_cells(ns, NULL, scopecells, NULL, nil);
+}
+
+
+/**
+   Sets slot i of fast to val, recording the displaced value (or nil
+   if the slot was unset) in displaced under key, unless displaced is
+   NULL. A val of nil clears the slot. Steals the reference to val.
+ */
+static inline int slot_swap(PyObject **fast, Py_ssize_t i, PyObject *key,
+			    PyObject *val, PyObject *nil,
+			    PyObject *displaced) {
+
+  PyObject *old = fast[i];
+  int ret;
+
+  if (val == nil) {
+    fast[i] = NULL;
+    Py_DECREF(val);
+  } else {
+    fast[i] = val;
+  }
+
+  ret = displaced? PyDict_SetItem(displaced, key, old? old: nil): 0;
+  Py_XDECREF(old);
+
+  return ret;
+}
+
+
+/**
+   Checks that slot i of a frame of code, holding old, may be bound by
+   a scope. Unless the interpreter is safe from fast locals being made
+   unset (see FAST_UNSET_SAFE), a scope can't bind a local which is
+   unset, as it would have to be made unset again when the scope
+   exits. Returns -1 with UnboundLocalError set if not.
+ */
+static inline int slot_bindable(PyCodeObject *code, Py_ssize_t i,
+				PyObject *key, PyObject *old) {
+
+#if ! FAST_UNSET_SAFE
+  if (! old && (code->co_flags & CO_OPTIMIZED) &&
+      ! code_slot_is_cell(code, i)) {
+    PyErr_Format(PyExc_UnboundLocalError,
+		 "local variable '%U' must be assigned before a scope"
+		 " can bind it", key);
+    return -1;
+  }
+#endif
+
+  return 0;
+}
+
+
+/**
+   Creates the two dicts returned by frame_apply_vars and
+   frame_revert_vars, as a tuple
+ */
+static PyObject *displaced_new(PyObject **o_vars, PyObject **o_cells) {
   PyObject *ret = PyTuple_New(2);
 
-  o_vars = PyDict_New();
-  o_cells = PyDict_New();
+  if (ret) {
+    *o_vars = PyDict_New();
+    PyTuple_SET_ITEM(ret, 0, *o_vars);
 
-  PyTuple_SET_ITEM(ret, 0, o_vars);
-  PyTuple_SET_ITEM(ret, 1, o_cells);
+    *o_cells = PyDict_New();
+    PyTuple_SET_ITEM(ret, 1, *o_cells);
+
+    if (! (*o_vars && *o_cells)) {
+      Py_CLEAR(ret);
+    }
+  }
+
+  return ret;
+}
 
-  // first we go through locals, and if we find a var matching a
-  // defined name, we swap our value in and store the original in a
-  // dictionary so we can restore it later. The scope stores all its
-  // values wrapped in cells
-  for (i = code->co_nlocals; i--; ) {
-    key = PyTuple_GET_ITEM(code->co_varnames, i);
-    newcell = PyObject_GetItem(scopecells, key);
-
-    if (newcell) {
-      oldval = fast[i];
-      fast[i] = PyCell_Get(newcell);
-      PyObject_SetItem(o_vars, key, oldval? oldval: nil);
-      Py_XDECREF(oldval);
-      Py_DECREF(newcell);
+
+/**
+   Puts back the original values and cells which were recorded by
+   frame_apply_vars. nil is our sentinel value meaning that a var
+   should be cleared. The values and cells displaced are recorded in
+   o_vars and o_cells, using nil again if the var was unset while the
+   scope was active. A cell which was emptied while the scope was
+   active (by deleting the variable) is also recorded as nil in
+   o_vars, so that the name is dropped from the scope. If o_vars and
+   o_cells are NULL the displaced values are simply dropped.
+ */
+static int revert_slots(PyFrameObject *frame,
+			PyObject *revert_vars, PyObject *revert_cells,
+			PyObject *nil, PyObject *o_vars, PyObject *o_cells) {
+
+  PyCodeObject *code = frame_code(frame);
+  PyObject **fast = frame_fast(frame);
+  PyObject *key, *newval;
+  Py_ssize_t i;
+  int err;
+
+  for (i = code_nslots(code); i--; ) {
+    key = code_slot_name(code, i);
+    if (! key)
+      continue;
+
+    if (code_slot_is_cell(code, i)) {
+      newval = PyDict_GetItem(revert_cells, key);
+      if (! newval)
+	continue;
+      if (o_vars && fast[i] && ! PyCell_GET(fast[i]) &&
+	  PyDict_SetItem(o_vars, key, nil))
+	return -1;
+      Py_INCREF(newval);
+      err = slot_swap(fast, i, key, newval, nil, o_cells);
 
     } else {
-      PyErr_Clear();
+      newval = PyDict_GetItem(revert_vars, key);
+      if (! newval)
+	continue;
+      Py_INCREF(newval);
+      err = slot_swap(fast, i, key, newval, nil, o_vars);
     }
+
+    if (err)
+      return -1;
   }
 
-  offset = code->co_nlocals;
-  fast_cells_swap(fast, offset, code->co_cellvars, scopecells, o_cells);
+  return 0;
+}
+
+
+static PyObject *frame_revert_vars(PyObject *self, PyObject *args) {
+  PyFrameObject *frame = NULL;
+  PyObject *revert_vars, *revert_cells;
+  PyObject *nil = NULL;
+
+  if (! PyArg_ParseTuple(args, "O!O!O!O",
+			 &PyFrame_Type, &frame,
+			 &PyDict_Type, &revert_vars,
+			 &PyDict_Type, &revert_cells,
+			 &nil))
+    return NULL;
+
+  PyObject *o_vars, *o_cells;
+  PyObject *ret = displaced_new(&o_vars, &o_cells);
+  if (! ret)
+    return NULL;
 
-  offset += PyTuple_GET_SIZE(code->co_cellvars);
-  fast_cells_swap(fast, offset, code->co_freevars, scopecells, o_cells);
+  if (revert_slots(frame, revert_vars, revert_cells, nil,
+		   o_vars, o_cells)) {
+    Py_DECREF(ret);
+    return NULL;
+  }
 
   return ret;
 }
 
 
-static PyMethodDef methods[] = {
-  { "cell_from_value", cell_from_value, METH_VARARGS,
-    "create a cell wrapping a value" },
+/**
+   As frame_revert_vars, but for scopes which discard their changes.
+   Nothing is read back out of the frame, so there's no need to
+   collect the displaced values.
+ */
+static PyObject *frame_restore_vars(PyObject *self, PyObject *args) {
+  PyFrameObject *frame = NULL;
+  PyObject *revert_vars, *revert_cells;
+  PyObject *nil = NULL;
 
-  { "cell_get_value", cell_get_value, METH_VARARGS,
-    "get a value from inside a cell" },
+  if (! PyArg_ParseTuple(args, "O!O!O!O",
+			 &PyFrame_Type, &frame,
+			 &PyDict_Type, &revert_vars,
+			 &PyDict_Type, &revert_cells,
+			 &nil))
+    return NULL;
 
-  { "cell_set_value", cell_set_value, METH_VARARGS,
-    "set a cell's value" },
+  if (revert_slots(frame, revert_vars, revert_cells, nil, NULL, NULL))
+    return NULL;
 
-  { "frame_set_f_globals", frame_set_f_globals, METH_VARARGS,
-    "set a frame's globals" },
+  Py_RETURN_NONE;
+}
 
-  { "frame_apply_vars", frame_apply_vars, METH_VARARGS,
-    ("replaces fast locals and cells with values and cells from the"
-     " given dict. Returns a tuple of two dicts of original vals and"
-     " cells.") },
 
-  { "frame_revert_vars", frame_revert_vars, METH_VARARGS,
-    ("reverts changes made by frame_apply_vars by restoring the"
-     " values and cells given. Returns the values replaced") },
+/**
+   Applies the values and cells from the dict scopecells to the
+   matching slots of frame. If fresh is true, cell and free vars are
+   given new cells holding the scope's values rather than the scope's
+   own cells, so that writes through them can't reach the scope.
+ */
+static PyObject *frame_apply_vars(PyObject *self, PyObject *args) {
+  PyFrameObject *frame = NULL;
+  PyObject *scopecells = NULL;
+  PyObject *nil = NULL;
+  int fresh = 0;
 
-  { NULL, NULL, 0, NULL },
-};
+  if (! PyArg_ParseTuple(args, "O!O!O|i",
+			 &PyFrame_Type, &frame,
+			 &PyDict_Type, &scopecells,
+			 &nil, &fresh))
+    return NULL;
 
+  PyCodeObject *code = frame_code(frame);
+  PyObject **fast = frame_fast(frame);
+  PyObject *key, *newcell, *newval;
+  Py_ssize_t i;
+  int err;
 
-PyMODINIT_FUNC init_frame() {
-  Py_InitModule("withscope._frame", methods);
-}
+  PyObject *o_vars, *o_cells;
+  PyObject *ret = displaced_new(&o_vars, &o_cells);
+  if (! ret)
+    return NULL;
+
+  // first we go through the slots, and if we find a var matching a
+  // defined name, we swap our value in and store the original in a
+  // dictionary so we can restore it later. The scope stores all its
+  // values wrapped in cells. Cell and free vars get our cell itself,
+  // so that closures created inside the scope capture it.
+  for (i = code_nslots(code); i--; ) {
+    key = code_slot_name(code, i);
+    if (! key)
+      continue;
+
+    newcell = PyDict_GetItem(scopecells, key);
+    if (! newcell)
+      continue;
+
+    if (code_slot_is_cell(code, i)) {
+      if (fresh)
+	newcell = PyCell_New(PyCell_GET(newcell));
+      else
+	Py_INCREF(newcell);
+      err = newcell? slot_swap(fast, i, key, newcell, nil, o_cells): -1;
+
+    } else {
+      newval = PyCell_GET(newcell);
+      if (! newval) {
+	PyErr_SetString(PyExc_ValueError, "empty cell in scope");
+	err = -1;
+      } else if (slot_bindable(code, i, key, fast[i])) {
+	err = -1;
+      } else {
+	Py_INCREF(newval);
+	err = slot_swap(fast, i, key, newval, nil, o_vars);
+      }
+    }
+
+    if (err) {
+      // put back the slots we've already swapped, so that the frame
+      // isn't left partially applied
+      PyObject *exc, *exc_val, *exc_tb;
+      PyErr_Fetch(&exc, &exc_val, &exc_tb);
+      if (revert_slots(frame, o_vars, o_cells, nil, NULL, NULL))
+	PyErr_Clear();
+      PyErr_Restore(exc, exc_val, exc_tb);
+
+      Py_DECREF(ret);
+      return NULL;
+    }
+  }
+
+  return ret;
+}
+
+
+/**
+   Sets the values from updates into the matching cells of the dict
+   scopecells, creating new cells for names which aren't present. New
+   names are interned, as code_has_slot expects.
+ */
+static int cells_set(PyObject *scopecells, PyObject *updates) {
+  PyObject *key, *val, *cell;
+  Py_ssize_t pos = 0;
+  int err;
+
+  while (PyDict_Next(updates, &pos, &key, &val)) {
+    cell = PyDict_GetItem(scopecells, key);
+
+    if (cell) {
+      err = PyCell_Set(cell, val);
+
+    } else {
+      cell = PyCell_New(val);
+      if (! cell)
+	return -1;
+
+      Py_INCREF(key);
+      if (name_is_uninterned(key))
+	name_intern(&key);
+
+      err = PyDict_SetItem(scopecells, key, cell);
+      Py_DECREF(key);
+      Py_DECREF(cell);
+    }
+
+    if (err)
+      return -1;
+  }
+
+  return 0;
+}
+
+
+static PyObject *cells_update(PyObject *self, PyObject *args) {
+  PyObject *scopecells = NULL;
+  PyObject *updates = NULL;
+
+  if (! PyArg_ParseTuple(args, "O!O!",
+			 &PyDict_Type, &scopecells,
+			 &PyDict_Type, &updates))
+    return NULL;
+
+  if (cells_set(scopecells, updates))
+    return NULL;
+
+  Py_RETURN_NONE;
+}
+
+
+/**
+   A new dict of the values in the cells of the dict scopecells,
+   leaving out those which are empty (the frame deleted the name
+   while the scope was active).
+ */
+static PyObject *cells_values(PyObject *self, PyObject *args) {
+  PyObject *scopecells = NULL;
+
+  if (! PyArg_ParseTuple(args, "O!",
+			 &PyDict_Type, &scopecells))
+    return NULL;
+
+  PyObject *values, *key, *cell, *val;
+  Py_ssize_t pos = 0;
+
+  values = PyDict_New();
+  if (! values)
+    return NULL;
+
+  while (PyDict_Next(scopecells, &pos, &key, &cell)) {
+    val = PyCell_GET(cell);
+    if (val && PyDict_SetItem(values, key, val)) {
+      Py_DECREF(values);
+      return NULL;
+    }
+  }
+
+  return values;
+}
+
+
+/**
+   Stores the values in changes, as read back out of a frame, into the
+   matching cells of the dict scopecells. nil as a value means that
+   the frame deleted the name, which is removed. Names which
+   scopecells doesn't bind are ignored.
+
+   If own isn't None, scopecells is the flattened view of a child
+   scope, whose own cells are in the dict own. The rest are its
+   parent's, and aren't written to. Instead a new cell is added to
+   own if the frame changed the value, and a deleted name is marked
+   as nil in own. Whether the frame changed a value is decided by
+   comparing it to the one in the dict applied, which holds the
+   values as they were when the scope was applied to the frame (see
+   cells_values), so that the parent may change its values in the
+   meantime. Returns True if the names bound (or their cells)
+   changed.
+ */
+static PyObject *cells_readback(PyObject *self, PyObject *args) {
+  PyObject *scopecells = NULL;
+  PyObject *changes = NULL;
+  PyObject *nil = NULL;
+  PyObject *own = NULL;
+  PyObject *applied = NULL;
+
+  if (! PyArg_ParseTuple(args, "O!O!OOO",
+			 &PyDict_Type, &scopecells,
+			 &PyDict_Type, &changes,
+			 &nil, &own, &applied))
+    return NULL;
+
+  if (own != Py_None && ! (PyDict_Check(own) && PyDict_Check(applied))) {
+    PyErr_SetString(PyExc_TypeError, "own and applied must be dicts");
+    return NULL;
+  }
+
+  PyObject *key, *val, *cell;
+  Py_ssize_t pos = 0;
+  int changed = 0, err;
+
+  while (PyDict_Next(changes, &pos, &key, &val)) {
+    cell = PyDict_GetItem(scopecells, key);
+    if (! cell)
+      continue;
+
+    if (own == Py_None || PyDict_GetItem(own, key) == cell) {
+      if (val != nil) {
+	err = PyCell_Set(cell, val);
+      } else if (own == Py_None) {
+	err = PyDict_DelItem(scopecells, key);
+	changed = 1;
+      } else {
+	err = PyDict_SetItem(own, key, nil);
+	changed = 1;
+      }
+
+    } else if (val == nil) {
+      err = PyDict_SetItem(own, key, nil);
+      changed = 1;
+
+    } else if (val != PyDict_GetItem(applied, key)) {
+      cell = PyCell_New(val);
+      if (! cell)
+	return NULL;
+      err = PyDict_SetItem(own, key, cell);
+      Py_DECREF(cell);
+      changed = 1;
+
+    } else {
+      err = 0;
+    }
+
+    if (err)
+      return NULL;
+  }
+
+  return PyBool_FromLong(changed);
+}
+
+
+/**
+   Makes the dict scopecells, its keys, its cells, and their values
+   immortal where the interpreter supports it (CPython 3.12 and
+   later), so that applying the cells to frames doesn't write to
+   their reference counts. Returns True if they were made immortal,
+   or False if that isn't supported.
+ */
+static PyObject *cells_freeze(PyObject *self, PyObject *args) {
+  PyObject *scopecells = NULL;
+
+  if (! PyArg_ParseTuple(args, "O!",
+			 &PyDict_Type, &scopecells))
+    return NULL;
+
+#ifdef HAVE_IMMORTAL
+  PyObject *key, *cell, *val;
+  Py_ssize_t pos = 0;
+
+  while (PyDict_Next(scopecells, &pos, &key, &cell)) {
+    val = PyCell_GET(cell);
+    if (val)
+      obj_set_immortal(val);
+    obj_set_immortal(cell);
+    obj_set_immortal(key);
+  }
+
+  obj_set_immortal(scopecells);
+  Py_RETURN_TRUE;
+
+#else
+  Py_RETURN_FALSE;
+#endif
+}
+
+
+/**
+   Writes the values in updates into the cells of the dict scopecells
+   and into a frame which that scope is currently applied to, in a
+   single pass over the frame's slots.
+
+   o_vars, o_cells, and o_globals are the records of the frame's
+   original values, as returned from frame_apply_vars and
+   frame_apply_globals. Names which the scope didn't previously bind
+   have their original value added to the appropriate record, so that
+   reverting the frame puts them back as well. fresh must match the
+   value given to frame_apply_vars.
+ */
+static PyObject *frame_update_vars(PyObject *self, PyObject *args) {
+  PyFrameObject *frame = NULL;
+  PyObject *scopecells, *updates;
+  PyObject *o_vars, *o_cells, *o_globals;
+  PyObject *nil = NULL;
+  int fresh = 0;
+
+  if (! PyArg_ParseTuple(args, "O!O!O!O!O!O!O|i",
+			 &PyFrame_Type, &frame,
+			 &PyDict_Type, &scopecells,
+			 &PyDict_Type, &updates,
+			 &PyDict_Type, &o_vars,
+			 &PyDict_Type, &o_cells,
+			 &PyDict_Type, &o_globals,
+			 &nil, &fresh))
+    return NULL;
+
+  PyCodeObject *code = frame_code(frame);
+  PyObject **fast = frame_fast(frame);
+  PyObject *key, *val, *cell, *old, *ns, *mirror;
+  Py_ssize_t i, pos, found = 0;
+  int err = 0;
+
+  // nothing is changed if one of the new names can't be bound
+  for (i = code_nslots(code); i--; ) {
+    key = code_slot_name(code, i);
+    if (key && PyDict_GetItem(updates, key) &&
+	! PyDict_GetItem(o_vars, key) &&
+	slot_bindable(code, i, key, fast[i]))
+      return NULL;
+  }
+
+  // names which were found in the frame's slots
+  PyObject *slotted = PySet_New(NULL);
+  if (! slotted)
+    return NULL;
+
+  if (cells_set(scopecells, updates))
+    goto error;
+
+  for (i = code_nslots(code); i--; ) {
+    key = code_slot_name(code, i);
+    if (! key)
+      continue;
+
+    val = PyDict_GetItem(updates, key);
+    if (! val)
+      continue;
+
+    if (code_slot_is_cell(code, i)) {
+      old = fast[i];
+
+      if (PyDict_GetItem(o_cells, key)) {
+	// the slot already holds one of our cells
+	if (fresh) {
+	  err = PyCell_Set(old, val);
+	} else if (old != (cell = PyDict_GetItem(scopecells, key))) {
+	  Py_INCREF(cell);
+	  err = slot_swap(fast, i, key, cell, nil, NULL);
+	}
+
+      } else {
+	if (fresh) {
+	  cell = PyCell_New(val);
+	  if (! cell)
+	    goto error;
+	} else {
+	  cell = PyDict_GetItem(scopecells, key);
+	  Py_INCREF(cell);
+	}
+	err = slot_swap(fast, i, key, cell, nil, o_cells);
+      }
+
+    } else {
+      Py_INCREF(val);
+      if (PyDict_GetItem(o_vars, key)) {
+	err = slot_swap(fast, i, key, val, nil, NULL);
+      } else {
+	err = slot_swap(fast, i, key, val, nil, o_vars);
+      }
+    }
+
+    if (err || PySet_Add(slotted, key))
+      goto error;
+
+    found++;
+  }
+
+  // anything which didn't have a slot goes into the namespace
+  if (found < PyDict_Size(updates)) {
+    ns = frame_namespace(frame, &mirror);
+    pos = 0;
+
+    while (PyDict_Next(updates, &pos, &key, &val)) {
+      if (PySet_Contains(slotted, key))
+	continue;
+
+      if (PyDict_GetItem(o_globals, key)) {
+	err = ns_swap(ns, mirror, key, val, nil, NULL);
+      } else {
+	err = ns_swap(ns, mirror, key, val, nil, o_globals);
+      }
+
+      if (err)
+	goto error;
+    }
+  }
+
+  Py_DECREF(slotted);
+  Py_RETURN_NONE;
+
+ error:
+  Py_DECREF(slotted);
+  return NULL;
+}
+
+
+/**
+   Resolves the names in keys against the slots of code, producing a
+   plan which frame_apply_plan can use to apply a scope binding
+   exactly those names to any frame of code, without searching for
+   them again. The plan is a tuple of three tuples: (index, name)
+   pairs for the value slots, (index, name) pairs for the cell slots,
+   and the names which must go into the frame's namespace.
+ */
+static PyObject *slot_plan(PyCodeObject *code, PyObject *keys) {
+  PyObject *vslots = PyList_New(0);
+  PyObject *cslots = PyList_New(0);
+  PyObject *gkeys = PyList_New(0);
+  PyObject *iter = NULL, *key, *pair, *ret = NULL;
+  Py_ssize_t i;
+  int found;
+
+  if (! (vslots && cslots && gkeys))
+    goto done;
+
+  for (i = 0; i < code_nslots(code); i++) {
+    key = code_slot_name(code, i);
+    if (! key)
+      continue;
+
+    found = PySequence_Contains(keys, key);
+    if (found < 0)
+      goto done;
+    else if (! found)
+      continue;
+
+    pair = Py_BuildValue("(nO)", i, key);
+    if (! pair)
+      goto done;
+
+    found = PyList_Append(code_slot_is_cell(code, i)? cslots: vslots, pair);
+    Py_DECREF(pair);
+    if (found)
+      goto done;
+  }
+
+  // as with frame_apply_globals, unoptimized code gets every binding
+  // placed in its namespace
+  iter = PyObject_GetIter(keys);
+  if (! iter)
+    goto done;
+
+  while ((key = PyIter_Next(iter))) {
+    if (! (code->co_flags & CO_OPTIMIZED) || ! code_has_slot(code, key))
+      found = PyList_Append(gkeys, key);
+    else
+      found = 0;
+
+    Py_DECREF(key);
+    if (found)
+      goto done;
+  }
+
+  if (! PyErr_Occurred())
+    ret = Py_BuildValue("(NNN)", PyList_AsTuple(vslots),
+			PyList_AsTuple(cslots), PyList_AsTuple(gkeys));
+
+ done:
+  Py_XDECREF(iter);
+  Py_XDECREF(vslots);
+  Py_XDECREF(cslots);
+  Py_XDECREF(gkeys);
+  return ret;
+}
+
+
+static PyObject *code_slot_plan(PyObject *self, PyObject *args) {
+  PyCodeObject *code = NULL;
+  PyObject *keys = NULL;
+
+  if (! PyArg_ParseTuple(args, "O!O",
+			 &PyCode_Type, &code,
+			 &keys))
+    return NULL;
+
+  return slot_plan(code, keys);
+}
+
+
+/**
+   True if the set keys holds exactly the keys of dict cells
+ */
+static int keys_match(PyObject *keys, PyObject *cells) {
+  PyObject *key, *val;
+  Py_ssize_t pos = 0;
+  int found;
+
+  if (PySet_GET_SIZE(keys) != PyDict_Size(cells))
+    return 0;
+
+  while (PyDict_Next(cells, &pos, &key, &val)) {
+    found = PySet_Contains(keys, key);
+    if (found <= 0)
+      return found;
+  }
+
+  return 1;
+}
+
+
+/**
+   Makes room in the dict sites of frame_site_plan, by removing every
+   site which hasn't been promoted to a plan. If that doesn't free at
+   least a quarter of limit, the hot sites go as well, so that a full
+   table isn't searched again for every new site.
+ */
+static int sites_evict(PyObject *sites, Py_ssize_t limit) {
+  PyObject *key, *site;
+  Py_ssize_t pos = 0, i;
+  int err = 0;
+
+  PyObject *cold = PyList_New(0);
+  if (! cold)
+    return -1;
+
+  while (! err && PyDict_Next(sites, &pos, &key, &site)) {
+    if (site == Py_None || PyList_GET_ITEM(site, 3) == Py_None)
+      err = PyList_Append(cold, key);
+  }
+
+  for (i = 0; ! err && i < PyList_GET_SIZE(cold); i++)
+    err = PyDict_DelItem(sites, PyList_GET_ITEM(cold, i));
+
+  Py_DECREF(cold);
+
+  if (! err && PyDict_Size(sites) > limit - limit / 4)
+    PyDict_Clear(sites);
+
+  return err;
+}
+
+
+/**
+   The inline cache behind the slot plans of Scope. sites is a dict
+   mapping (id(code), lasti) to a [code, keys, hits, plan] list for
+   each site which has entered a scope more than once. A site entered
+   only once is mapped to None, so that code which only runs once
+   (eg. at import) costs little to track. When the site in frame has
+   entered scopes binding exactly the keys of cells hot times in a
+   row, a plan is resolved via code_slot_plan and returned for every
+   following entry, until a scope binding other names is entered
+   there. Otherwise returns None. Once sites reaches limit, room is
+   made via sites_evict.
+ */
+static PyObject *frame_site_plan(PyObject *self, PyObject *args) {
+  PyFrameObject *frame = NULL;
+  PyObject *cells = NULL;
+  PyObject *sites = NULL;
+  Py_ssize_t hot = 0, limit = 0;
+
+  if (! PyArg_ParseTuple(args, "O!O!O!nn",
+			 &PyFrame_Type, &frame,
+			 &PyDict_Type, &cells,
+			 &PyDict_Type, &sites,
+			 &hot, &limit))
+    return NULL;
+
+  PyCodeObject *code = frame_code(frame);
+  PyObject *site_key, *site, *keys, *count, *plan;
+  Py_ssize_t hits;
+  int found;
+
+  // code objects hash by value, which is far too slow to do on every
+  // entry, so sites are keyed by identity instead. The site record
+  // keeps its code alive, so the id can't be reused out from under
+  // it. The None of a site entered once doesn't, but mistaking a new
+  // code object for it only means being tracked one entry sooner.
+  site_key = Py_BuildValue("(Ni)", PyLong_FromVoidPtr(code),
+			   frame_lasti(frame));
+  if (! site_key)
+    return NULL;
+
+  site = PyDict_GetItem(sites, site_key);
+
+  if (! site) {
+    found = ((PyDict_Size(sites) >= limit && sites_evict(sites, limit)) ||
+	     PyDict_SetItem(sites, site_key, Py_None));
+
+    Py_DECREF(site_key);
+    if (found)
+      return NULL;
+    Py_RETURN_NONE;
+
+  } else if (site == Py_None) {
+    keys = PyFrozenSet_New(cells);
+    site = keys? Py_BuildValue("[ONiO]", code, keys, 0, Py_None): NULL;
+    found = site? PyDict_SetItem(sites, site_key, site): -1;
+
+    Py_XDECREF(site);
+    Py_DECREF(site_key);
+    if (found)
+      return NULL;
+    Py_RETURN_NONE;
+  }
+
+  Py_DECREF(site_key);
+
+  found = keys_match(PyList_GET_ITEM(site, 1), cells);
+  if (found < 0)
+    return NULL;
+
+  if (! found) {
+    // a different set of names, so drop back to the generic path and
+    // start counting again
+    keys = PyFrozenSet_New(cells);
+    count = PyLong_FromLong(0);
+    if (! (keys && count)) {
+      Py_XDECREF(keys);
+      Py_XDECREF(count);
+      return NULL;
+    }
+
+    PyList_SetItem(site, 1, keys);
+    PyList_SetItem(site, 2, count);
+    Py_INCREF(Py_None);
+    PyList_SetItem(site, 3, Py_None);
+    Py_RETURN_NONE;
+  }
+
+  plan = PyList_GET_ITEM(site, 3);
+  if (plan == Py_None) {
+    hits = PyNumber_AsSsize_t(PyList_GET_ITEM(site, 2), NULL) + 1;
+    count = PyLong_FromSsize_t(hits);
+    if (! count)
+      return NULL;
+
+    PyList_SetItem(site, 2, count);
+
+    if (hits < hot)
+      Py_RETURN_NONE;
+
+    plan = slot_plan(code, PyList_GET_ITEM(site, 1));
+    if (! plan)
+      return NULL;
+
+    PyList_SetItem(site, 3, plan);
+  }
+
+  Py_INCREF(plan);
+  return plan;
+}
+
+
+/**
+   Unpacks one (index, name) pair of a plan, checking that the index
+   is in range for code
+ */
+static int plan_slot(PyObject *slots, Py_ssize_t j, PyCodeObject *code,
+		     Py_ssize_t *index, PyObject **key) {
+
+  PyObject *pair = PyTuple_GET_ITEM(slots, j);
+
+  *index = PyNumber_AsSsize_t(PyTuple_GET_ITEM(pair, 0), NULL);
+  *key = PyTuple_GET_ITEM(pair, 1);
+
+  if (*index < 0 || *index >= code_nslots(code)) {
+    if (! PyErr_Occurred())
+      PyErr_SetString(PyExc_ValueError, "plan does not match frame");
+    return -1;
+  }
+
+  return 0;
+}
+
+
+static int plan_unpack(PyObject *plan, PyObject **vslots,
+		       PyObject **cslots, PyObject **gkeys) {
+
+  return PyArg_ParseTuple(plan, "O!O!O!",
+			  &PyTuple_Type, vslots,
+			  &PyTuple_Type, cslots,
+			  &PyTuple_Type, gkeys)? 0: -1;
+}
+
+
+/**
+   Checks that each of the value slots of a plan may be bound in
+   frame, as by slot_bindable.
+ */
+static int plan_check_slots(PyFrameObject *frame, PyObject *vslots) {
+#if ! FAST_UNSET_SAFE
+  PyCodeObject *code = frame_code(frame);
+  PyObject **fast = frame_fast(frame);
+  PyObject *key;
+  Py_ssize_t i, j;
+
+  for (j = 0; j < PyTuple_GET_SIZE(vslots); j++) {
+    if (plan_slot(vslots, j, code, &i, &key) ||
+	slot_bindable(code, i, key, fast[i]))
+      return -1;
+  }
+#endif
+
+  return 0;
+}
+
+
+/**
+   Applies the value and cell slots of a plan from code_slot_plan to
+   frame. The original values are stored into the tuple saved_vars
+   starting at voff, and the original cells into the tuple
+   saved_cells starting at coff, in the order of the plan. Both
+   tuples must be new, with room for them.
+
+   Everything that could fail is checked before the frame is changed,
+   so on failure returns -1 and the frame is left as it was.
+ */
+static int apply_plan_slots(PyFrameObject *frame, PyObject *vslots,
+			    PyObject *cslots, PyObject *scopecells,
+			    PyObject *nil, int fresh,
+			    PyObject *saved_vars, Py_ssize_t voff,
+			    PyObject *saved_cells, Py_ssize_t coff) {
+
+  PyCodeObject *code = frame_code(frame);
+  PyObject **fast = frame_fast(frame);
+  PyObject *key, *cell, *val, *old;
+  Py_ssize_t i, j;
+
+  // gather the values and cells to be swapped in, which are then
+  // swapped for the originals in place
+  for (j = 0; j < PyTuple_GET_SIZE(vslots); j++) {
+    if (plan_slot(vslots, j, code, &i, &key))
+      return -1;
+
+    cell = PyDict_GetItem(scopecells, key);
+    val = cell? PyCell_GET(cell): NULL;
+    if (! val) {
+      PyErr_SetString(PyExc_ValueError, "plan does not match scope");
+      return -1;
+    }
+
+    if (slot_bindable(code, i, key, fast[i]))
+      return -1;
+
+    Py_INCREF(val);
+    PyTuple_SET_ITEM(saved_vars, voff + j, val);
+  }
+
+  for (j = 0; j < PyTuple_GET_SIZE(cslots); j++) {
+    if (plan_slot(cslots, j, code, &i, &key))
+      return -1;
+
+    cell = PyDict_GetItem(scopecells, key);
+    if (! cell) {
+      PyErr_SetString(PyExc_ValueError, "plan does not match scope");
+      return -1;
+    }
+
+    if (fresh) {
+      cell = PyCell_New(PyCell_GET(cell));
+      if (! cell)
+	return -1;
+    } else {
+      Py_INCREF(cell);
+    }
+    PyTuple_SET_ITEM(saved_cells, coff + j, cell);
+  }
+
+  for (j = 0; j < PyTuple_GET_SIZE(vslots); j++) {
+    plan_slot(vslots, j, code, &i, &key);
+    old = fast[i];
+    fast[i] = PyTuple_GET_ITEM(saved_vars, voff + j);
+
+    if (! old) {
+      old = nil;
+      Py_INCREF(old);
+    }
+    PyTuple_SET_ITEM(saved_vars, voff + j, old);
+  }
+
+  for (j = 0; j < PyTuple_GET_SIZE(cslots); j++) {
+    plan_slot(cslots, j, code, &i, &key);
+    old = fast[i];
+    fast[i] = PyTuple_GET_ITEM(saved_cells, coff + j);
+
+    if (! old) {
+      old = nil;
+      Py_INCREF(old);
+    }
+    PyTuple_SET_ITEM(saved_cells, coff + j, old);
+  }
+
+  return 0;
+}
+
+
+/**
+   Swaps the values of scopecells named by gkeys into ns, recording
+   the values displaced in originals. If a swap fails the recorded
+   values are put back.
+ */
+static int apply_plan_ns(PyObject *ns, PyObject *mirror, PyObject *gkeys,
+			 PyObject *scopecells, PyObject *nil,
+			 PyObject *originals) {
+
+  PyObject *key, *cell, *val;
+  Py_ssize_t j;
+
+  for (j = 0; j < PyTuple_GET_SIZE(gkeys); j++) {
+    key = PyTuple_GET_ITEM(gkeys, j);
+    cell = PyDict_GetItem(scopecells, key);
+    val = cell? PyCell_GET(cell): NULL;
+    if (! val) {
+      PyErr_SetString(PyExc_ValueError, "plan does not match scope");
+    } else if (! ns_swap(ns, mirror, key, val, nil, originals)) {
+      continue;
+    }
+
+    ns_unswap(ns, mirror, originals, nil);
+    return -1;
+  }
+
+  return 0;
+}
+
+
+/**
+   Puts back the values and cells saved by apply_plan_slots, from
+   saved_vars starting at voff and saved_cells starting at coff. If
+   current is not NULL, the values displaced from the value slots are
+   recorded in it, using nil for those the frame had unset, and for
+   cells which were emptied (as in revert_slots).
+ */
+static int revert_plan(PyFrameObject *frame, PyObject *plan,
+		       PyObject *saved_vars, Py_ssize_t voff,
+		       PyObject *saved_cells, Py_ssize_t coff,
+		       PyObject *nil, PyObject *current) {
+
+  PyCodeObject *code = frame_code(frame);
+  PyObject **fast = frame_fast(frame);
+  PyObject *vslots, *cslots, *gkeys, *key, *val;
+  Py_ssize_t i, j;
+
+  if (plan_unpack(plan, &vslots, &cslots, &gkeys))
+    return -1;
+
+  if (PyTuple_GET_SIZE(saved_vars) < voff + PyTuple_GET_SIZE(vslots) ||
+      PyTuple_GET_SIZE(saved_cells) < coff + PyTuple_GET_SIZE(cslots)) {
+    PyErr_SetString(PyExc_ValueError, "saved values do not match plan");
+    return -1;
+  }
+
+  for (j = PyTuple_GET_SIZE(vslots); j--; ) {
+    if (plan_slot(vslots, j, code, &i, &key))
+      return -1;
+
+    val = PyTuple_GET_ITEM(saved_vars, voff + j);
+    Py_INCREF(val);
+    if (slot_swap(fast, i, key, val, nil, current))
+      return -1;
+  }
+
+  for (j = PyTuple_GET_SIZE(cslots); j--; ) {
+    if (plan_slot(cslots, j, code, &i, &key))
+      return -1;
+
+    if (current && fast[i] && ! PyCell_GET(fast[i]) &&
+	PyDict_SetItem(current, key, nil))
+      return -1;
+
+    val = PyTuple_GET_ITEM(saved_cells, coff + j);
+    Py_INCREF(val);
+    if (slot_swap(fast, i, key, val, nil, NULL))
+      return -1;
+  }
+
+  return 0;
+}
+
+
+/**
+   Applies the dict scopecells to frame using a plan from
+   code_slot_plan. Returns a tuple of the original values of the value
+   slots (in the order of the plan), the original cells of the cell
+   slots, and a dict of the original namespace values (or None), for
+   passing to frame_revert_plan. fresh is as for frame_apply_vars. If
+   the namespace can't be swapped the slots are put back, so an error
+   leaves the frame as it was.
+ */
+static PyObject *frame_apply_plan(PyObject *self, PyObject *args) {
+  PyFrameObject *frame = NULL;
+  PyObject *plan = NULL;
+  PyObject *scopecells = NULL;
+  PyObject *nil = NULL;
+  int fresh = 0;
+
+  if (! PyArg_ParseTuple(args, "O!O!O!O|i",
+			 &PyFrame_Type, &frame,
+			 &PyTuple_Type, &plan,
+			 &PyDict_Type, &scopecells,
+			 &nil, &fresh))
+    return NULL;
+
+  PyObject *vslots, *cslots, *gkeys;
+  PyObject *saved_vars, *saved_cells, *originals = NULL;
+  PyObject *ns, *mirror, *exc, *val, *tb;
+
+  if (plan_unpack(plan, &vslots, &cslots, &gkeys))
+    return NULL;
+
+  saved_vars = PyTuple_New(PyTuple_GET_SIZE(vslots));
+  saved_cells = PyTuple_New(PyTuple_GET_SIZE(cslots));
+  if (! (saved_vars && saved_cells))
+    goto error;
+
+  if (apply_plan_slots(frame, vslots, cslots, scopecells, nil, fresh,
+		       saved_vars, 0, saved_cells, 0))
+    goto error;
+
+  if (PyTuple_GET_SIZE(gkeys)) {
+    ns = frame_namespace(frame, &mirror);
+    originals = PyDict_New();
+
+    if (! originals ||
+	apply_plan_ns(ns, mirror, gkeys, scopecells, nil, originals)) {
+
+      PyErr_Fetch(&exc, &val, &tb);
+      if (revert_plan(frame, plan, saved_vars, 0, saved_cells, 0,
+		      nil, NULL))
+	PyErr_Clear();
+      PyErr_Restore(exc, val, tb);
+      goto error;
+    }
+
+  } else {
+    originals = Py_None;
+    Py_INCREF(originals);
+  }
+
+  return Py_BuildValue("(NNN)", saved_vars, saved_cells, originals);
+
+ error:
+  Py_XDECREF(saved_vars);
+  Py_XDECREF(saved_cells);
+  Py_XDECREF(originals);
+  return NULL;
+}
+
+
+/**
+   Reverts the changes made by frame_apply_plan, returning a dict of
+   the values displaced from the value slots. The namespace values
+   are reverted separately, via frame_swap_globals.
+ */
+static PyObject *frame_revert_plan(PyObject *self, PyObject *args) {
+  PyFrameObject *frame = NULL;
+  PyObject *plan, *saved_vars, *saved_cells;
+  PyObject *nil = NULL;
+
+  if (! PyArg_ParseTuple(args, "O!O!O!O!O",
+			 &PyFrame_Type, &frame,
+			 &PyTuple_Type, &plan,
+			 &PyTuple_Type, &saved_vars,
+			 &PyTuple_Type, &saved_cells,
+			 &nil))
+    return NULL;
+
+  PyObject *current = PyDict_New();
+  if (! current)
+    return NULL;
+
+  if (revert_plan(frame, plan, saved_vars, 0, saved_cells, 0, nil, current)) {
+    Py_DECREF(current);
+    return NULL;
+  }
+
+  return current;
+}
+
+
+/**
+   As frame_revert_plan, but discards the values displaced
+ */
+static PyObject *frame_restore_plan(PyObject *self, PyObject *args) {
+  PyFrameObject *frame = NULL;
+  PyObject *plan, *saved_vars, *saved_cells;
+  PyObject *nil = NULL;
+
+  if (! PyArg_ParseTuple(args, "O!O!O!O!O",
+			 &PyFrame_Type, &frame,
+			 &PyTuple_Type, &plan,
+			 &PyTuple_Type, &saved_vars,
+			 &PyTuple_Type, &saved_cells,
+			 &nil))
+    return NULL;
+
+  if (revert_plan(frame, plan, saved_vars, 0, saved_cells, 0, nil, NULL))
+    return NULL;
+
+  Py_RETURN_NONE;
+}
+
+
+/**
+   Checks that each item of the sequence frames is a frame, and that
+   they all share one code object, and claims an entry for each in
+   the dict records, mapped to None until its record is stored. Fails
+   without claiming any if a frame is already in records (or is
+   repeated in frames). Returns the shared code object (borrowed), or
+   NULL with an exception set.
+ */
+static PyCodeObject *claim_frames(PyObject *frames, PyObject *records) {
+  PyObject **items = PySequence_Fast_ITEMS(frames);
+  Py_ssize_t i, count = PySequence_Fast_GET_SIZE(frames);
+  PyCodeObject *code = NULL;
+  PyObject *exc, *val, *tb;
+  int found;
+
+  for (i = 0; i < count; i++) {
+    if (! PyFrame_Check(items[i])) {
+      PyErr_SetString(PyExc_TypeError, "expected a sequence of frames");
+      goto error;
+    }
+
+    if (! code) {
+      code = frame_code((PyFrameObject *) items[i]);
+    } else if (frame_code((PyFrameObject *) items[i]) != code) {
+      PyErr_SetString(PyExc_ValueError,
+		      "frames do not share a code object");
+      goto error;
+    }
+
+    found = PyDict_Contains(records, items[i]);
+    if (found < 0) {
+      goto error;
+    } else if (found) {
+      PyErr_SetString(PyExc_ValueError, "scope is already applied to frame");
+      goto error;
+    }
+
+    if (PyDict_SetItem(records, items[i], Py_None))
+      goto error;
+  }
+
+  return code;
+
+ error:
+  PyErr_Fetch(&exc, &val, &tb);
+  while (i--)
+    PyDict_DelItem(records, items[i]);
+  PyErr_Restore(exc, val, tb);
+  return NULL;
+}
+
+
+/**
+   Checks that each of frames has a record in the dict records, and
+   that none of them is repeated. Returns -1 with an exception set if
+   not.
+ */
+static int check_claimed(PyObject *frames, PyObject *records) {
+  PyObject **items = PySequence_Fast_ITEMS(frames);
+  Py_ssize_t i, count = PySequence_Fast_GET_SIZE(frames);
+  PyObject *record;
+  int err = 0;
+
+  PyObject *seen = PySet_New(NULL);
+  if (! seen)
+    return -1;
+
+  for (i = 0; ! err && i < count; i++) {
+    record = PyDict_GetItem(records, items[i]);
+    err = (record && record != Py_None)? PySet_Contains(seen, items[i]): 1;
+
+    if (err > 0) {
+      PyErr_SetString(PyExc_ValueError, "scope is not applied to frame");
+      err = -1;
+    } else if (! err) {
+      err = PySet_Add(seen, items[i]);
+    }
+  }
+
+  Py_DECREF(seen);
+  return err;
+}
+
+
+/**
+   Applies the dict scopecells to each of frames, which must all be
+   frames of the code object that plan was resolved against, in a
+   single pass. fresh is as for frame_apply_vars.
+
+   A record is stored in the dict records for each frame, keyed by
+   the frame. It's a single tuple of the plan, an ns_record (see
+   below), the original values of the value slots, and then the
+   original cells of the cell slots.
+
+   Bindings which go into a frame's namespace are swapped in only
+   once for each distinct namespace, no matter how many of the frames
+   share it. The namespaces dict maps the id of each such namespace
+   to an [ns, originals, count] ns_record, where count is the number
+   of frames applied over it. ns_record is None for frames where the
+   plan places nothing in the namespace. Unlike frame_apply_plan, a
+   function frame's materialized locals dict is not kept in step.
+ */
+static PyObject *frames_apply_plan(PyObject *self, PyObject *args) {
+  PyObject *frames = NULL;
+  PyObject *plan = NULL;
+  PyObject *scopecells = NULL;
+  PyObject *nil = NULL;
+  int fresh = 0;
+  PyObject *records = NULL;
+  PyObject *namespaces = NULL;
+
+  if (! PyArg_ParseTuple(args, "OO!O!OiO!O!",
+			 &frames,
+			 &PyTuple_Type, &plan,
+			 &PyDict_Type, &scopecells,
+			 &nil, &fresh,
+			 &PyDict_Type, &records,
+			 &PyDict_Type, &namespaces))
+    return NULL;
+
+  PyObject *vslots, *cslots, *gkeys;
+  PyObject *ns, *mirror, *ns_key, *ns_record, *originals, *total;
+  PyObject *frame, *record = NULL, *exc, *val, *tb;
+  Py_ssize_t i, n, nv, count;
+  int err, slotted = 0;
+
+  if (plan_unpack(plan, &vslots, &cslots, &gkeys))
+    return NULL;
+
+  nv = PyTuple_GET_SIZE(vslots);
+
+  frames = PySequence_Fast(frames, "expected a sequence of frames");
+  if (! frames)
+    return NULL;
+
+  count = PySequence_Fast_GET_SIZE(frames);
+
+  // nothing is changed unless every frame can be applied
+  if (count && ! claim_frames(frames, records)) {
+    Py_DECREF(frames);
+    return NULL;
+  }
+
+  for (i = 0; i < count; i++) {
+    frame = PySequence_Fast_GET_ITEM(frames, i);
+    if (plan_check_slots((PyFrameObject *) frame, vslots)) {
+      i = 0;
+      goto error;
+    }
+  }
+
+  for (i = 0; i < count; i++) {
+    frame = PySequence_Fast_GET_ITEM(frames, i);
+
+    record = PyTuple_New(2 + nv + PyTuple_GET_SIZE(cslots));
+    if (! record)
+      goto error;
+
+    Py_INCREF(plan);
+    PyTuple_SET_ITEM(record, 0, plan);
+
+    if (apply_plan_slots((PyFrameObject *) frame, vslots, cslots,
+			 scopecells, nil, fresh, record, 2, record, 2 + nv))
+      goto error;
+
+    slotted = 1;
+
+    ns_record = Py_None;
+    Py_INCREF(ns_record);
+
+    if (PyTuple_GET_SIZE(gkeys)) {
+      Py_DECREF(ns_record);
+
+      ns = frame_namespace((PyFrameObject *) frame, &mirror);
+      ns_key = PyLong_FromVoidPtr(ns);
+      if (! ns_key)
+	goto error;
+
+      ns_record = PyDict_GetItem(namespaces, ns_key);
+
+      if (ns_record) {
+	Py_INCREF(ns_record);
+	n = PyNumber_AsSsize_t(PyList_GET_ITEM(ns_record, 2), NULL);
+	total = PyLong_FromSsize_t(n + 1);
+	err = total? PyList_SetItem(ns_record, 2, total): -1;
+
+      } else {
+	originals = PyDict_New();
+	ns_record = originals? Py_BuildValue("[ONi]", ns, originals, 1): NULL;
+	err = (! ns_record ||
+	       apply_plan_ns(ns, NULL, gkeys, scopecells, nil, originals) ||
+	       PyDict_SetItem(namespaces, ns_key, ns_record));
+      }
+
+      Py_DECREF(ns_key);
+      if (err) {
+	Py_XDECREF(ns_record);
+	goto error;
+      }
+    }
+
+    PyTuple_SET_ITEM(record, 1, ns_record);
+
+    err = PyDict_SetItem(records, frame, record);
+    if (err)
+      goto error;
+
+    slotted = 0;
+    Py_CLEAR(record);
+  }
+
+  Py_DECREF(frames);
+  Py_RETURN_NONE;
+
+ error:
+  // frames applied before the error keep their records and can still
+  // be reverted, while the slots of the frame being applied are put
+  // back. Its namespace is either untouched or was already applied
+  // over by an earlier frame.
+  PyErr_Fetch(&exc, &val, &tb);
+
+  if (slotted &&
+      revert_plan((PyFrameObject *) frame, plan,
+		  record, 2, record, 2 + nv, nil, NULL))
+    PyErr_Clear();
+  Py_XDECREF(record);
+
+  for (; i < count; i++)
+    PyDict_DelItem(records, PySequence_Fast_GET_ITEM(frames, i));
+  PyErr_Restore(exc, val, tb);
+
+  Py_DECREF(frames);
+  return NULL;
+}
+
+
+/**
+   Puts back the values, cells, and namespace values saved by
+   frames_apply_plan for each of frames, discarding the values
+   displaced, and removes their records. A namespace is restored
+   once the last of the frames applied over it is restored.
+
+   Fails without reverting any if a frame isn't in records. If
+   reverting a frame fails, it and the frames after it keep their
+   records, so that they can still be reverted.
+ */
+static PyObject *frames_restore_plan(PyObject *self, PyObject *args) {
+  PyObject *frames = NULL;
+  PyObject *records = NULL;
+  PyObject *namespaces = NULL;
+  PyObject *nil = NULL;
+
+  if (! PyArg_ParseTuple(args, "OO!O!O",
+			 &frames,
+			 &PyDict_Type, &records,
+			 &PyDict_Type, &namespaces,
+			 &nil))
+    return NULL;
+
+  PyObject *frame, *record, *plan, *ns_record, *ns_key, *total;
+  Py_ssize_t i, n, nv;
+  int err;
+
+  frames = PySequence_Fast(frames, "expected a sequence of frames");
+  if (! frames)
+    return NULL;
+
+  err = check_claimed(frames, records);
+
+  for (i = 0; ! err && i < PySequence_Fast_GET_SIZE(frames); i++) {
+    frame = PySequence_Fast_GET_ITEM(frames, i);
+    record = PyDict_GetItem(records, frame);
+    plan = PyTuple_GET_ITEM(record, 0);
+    nv = PyTuple_GET_SIZE(PyTuple_GET_ITEM(plan, 0));
+
+    err = revert_plan((PyFrameObject *) frame, plan,
+		      record, 2, record, 2 + nv, nil, NULL);
+    if (err)
+      break;
+
+    // the count is only lowered once the namespace is restored, so
+    // that a failure here leaves the frame's record as it was
+    ns_record = PyTuple_GET_ITEM(record, 1);
+    if (ns_record != Py_None) {
+      n = PyNumber_AsSsize_t(PyList_GET_ITEM(ns_record, 2), NULL) - 1;
+
+      if (n) {
+	total = PyLong_FromSsize_t(n);
+	err = total? PyList_SetItem(ns_record, 2, total): -1;
+
+      } else {
+	ns_key = PyLong_FromVoidPtr(PyList_GET_ITEM(ns_record, 0));
+	err = (! ns_key ||
+	       swap_values(PyList_GET_ITEM(ns_record, 0), NULL,
+			   PyList_GET_ITEM(ns_record, 1), nil, NULL) ||
+	       PyDict_DelItem(namespaces, ns_key));
+	Py_XDECREF(ns_key);
+      }
+
+      if (err)
+	break;
+    }
+
+    err = PyDict_DelItem(records, frame);
+  }
+
+  Py_DECREF(frames);
+
+  if (err)
+    return NULL;
+
+  Py_RETURN_NONE;
+}
+
+
+static PyMethodDef methods[] = {
+  { "cell_from_value", cell_from_value, METH_VARARGS,
+    "create a cell wrapping a value" },
+
+  { "cell_get_value", cell_get_value, METH_VARARGS,
+    "get a value from inside a cell" },
+
+  { "cell_set_value", cell_set_value, METH_VARARGS,
+    "set a cell's value" },
+
+  { "cells_update", cells_update, METH_VARARGS,
+    "set values from a dict into a dict of cells, creating cells as needed" },
+
+  { "cells_values", cells_values, METH_VARARGS,
+    "get a dict of the values in a dict of cells, leaving out empty cells" },
+
+  { "cells_readback", cells_readback, METH_VARARGS,
+    ("stores values read back out of a frame into a dict of cells."
+     " Returns True if the names bound changed") },
+
+  { "cells_freeze", cells_freeze, METH_VARARGS,
+    ("makes a dict of cells and their values immortal, if supported."
+     " Returns True if so") },
+
+  { "frame_set_f_globals", frame_set_f_globals, METH_VARARGS,
+    "set a frame's globals" },
+
+  { "frame_swap_globals", frame_swap_globals, METH_VARARGS,
+    ("swaps values from the given dict into a frame's namespace. Returns"
+     " a dict of the values displaced.") },
+
+  { "frame_restore_globals", frame_restore_globals, METH_VARARGS,
+    ("restores the values from the given dict into a frame's namespace,"
+     " discarding those displaced.") },
+
+  { "frame_apply_globals", frame_apply_globals, METH_VARARGS,
+    ("swaps values from the given dict of cells into a frame's namespace,"
+     " for those names without a local slot. Returns a dict of the"
+     " values displaced, or None.") },
+
+  { "namespace_swap", namespace_swap, METH_VARARGS,
+    ("swaps values from the given dict into a namespace dict. Returns"
+     " a dict of the values displaced.") },
+
+  { "namespace_restore", namespace_restore, METH_VARARGS,
+    ("restores the values from the given dict into a namespace dict,"
+     " discarding those displaced.") },
+
+  { "namespace_apply_cells", namespace_apply_cells, METH_VARARGS,
+    ("swaps values from the given dict of cells into a namespace dict."
+     " Returns a dict of the values displaced, or None.") },
+
+  { "frame_apply_vars", frame_apply_vars, METH_VARARGS,
+    ("replaces fast locals and cells with values and cells from the"
+     " given dict. Returns a tuple of two dicts of original vals and"
+     " cells.") },
+
+  { "frame_revert_vars", frame_revert_vars, METH_VARARGS,
+    ("reverts changes made by frame_apply_vars by restoring the"
+     " values and cells given. Returns the values replaced") },
+
+  { "frame_restore_vars", frame_restore_vars, METH_VARARGS,
+    ("reverts changes made by frame_apply_vars by restoring the"
+     " values and cells given, discarding the values replaced") },
+
+  { "code_slot_plan", code_slot_plan, METH_VARARGS,
+    ("resolves a set of names against the slots of a code object,"
+     " returning a plan for frame_apply_plan") },
+
+  { "frame_site_plan", frame_site_plan, METH_VARARGS,
+    ("looks up the plan cached for the site in a frame which is"
+     " entering a scope, or None") },
+
+  { "frame_apply_plan", frame_apply_plan, METH_VARARGS,
+    ("applies a dict of cells to a frame using a plan from"
+     " code_slot_plan. Returns a tuple of the original values, cells,"
+     " and namespace values.") },
+
+  { "frame_revert_plan", frame_revert_plan, METH_VARARGS,
+    ("reverts changes made by frame_apply_plan. Returns a dict of the"
+     " values replaced") },
+
+  { "frame_restore_plan", frame_restore_plan, METH_VARARGS,
+    ("reverts changes made by frame_apply_plan, discarding the values"
+     " replaced") },
+
+  { "frames_apply_plan", frames_apply_plan, METH_VARARGS,
+    ("applies a dict of cells to many frames of one code object using a"
+     " plan from code_slot_plan, recording what was displaced") },
+
+  { "frames_restore_plan", frames_restore_plan, METH_VARARGS,
+    ("reverts changes made by frames_apply_plan, discarding the values"
+     " replaced") },
+
+  { "frame_update_vars", frame_update_vars, METH_VARARGS,
+    ("writes values from the given dict into a dict of cells, and into"
+     " the frame they are applied to") },
+
+  { NULL, NULL, 0, NULL },
+};
+
+
+#if PY_MAJOR_VERSION >= 3
+
+
+static struct PyModuleDef moduledef = {
+  PyModuleDef_HEAD_INIT,
+  "withscope._frame",
+  NULL,
+  -1,
+  methods,
+};
+
+
+PyMODINIT_FUNC PyInit__frame(void) {
+  return PyModule_Create(&moduledef);
+}
+
+
+#else
+
+
+PyMODINIT_FUNC init_frame(void) {
+  Py_InitModule("withscope._frame", methods);
+}
+
+
+#endif
 
 
 /* The end. */
@@ -0,0 +1,207 @@
+/*
+  This library is free software; you can redistribute it and/or modify
+  it under the terms of the GNU Lesser General Public License as
+  published by the Free Software Foundation; either version 3 of the
+  License, or (at your option) any later version.
+
+  This library is distributed in the hope that it will be useful, but
+  WITHOUT ANY WARRANTY; without even the implied warranty of
+  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+  Lesser General Public License for more details.
+
+  You should have received a copy of the GNU Lesser General Public
+  License along with this library; if not, see
+  <http://www.gnu.org/licenses/>.
+*/
+
+
+/**
+   Accessors for the parts of call frames and code objects that
+   frame.c needs to hack at. The layout differs between the Python 2
+   frame object and the interpreter frame introduced in CPython 3.11,
+   so each gets its own backend here.
+
+   Both backends present the frame's variables as a flat array of
+   slots. Each slot has a name, and either holds a value directly
+   (a fast local) or holds a cell (a cell or free variable). Note
+   that under Python 2 an argument captured by a closure has two
+   slots, one for the argument value and one for its cell, whereas
+   under Python 3 it has a single cell slot.
+
+   author: Christopher O'Brien  <obriencj@gmail.com>
+   license: LGPL v.3
+*/
+
+
+#ifndef WITHSCOPE_FRAME_COMPAT_H
+#define WITHSCOPE_FRAME_COMPAT_H
+
+
+#include <Python.h>
+#include <frameobject.h>
+
+
+#if PY_MAJOR_VERSION >= 3
+
+
+#if PY_VERSION_HEX < 0x030B0000
+#error "withscope requires CPython 2.6, 2.7, or 3.11 to 3.13"
+#endif
+
+/* from 3.14 the slots of localsplus are _PyStackRef rather than
+   PyObject pointers, which this backend doesn't handle */
+#if PY_VERSION_HEX >= 0x030E0000
+#error "withscope requires CPython 2.6, 2.7, or 3.11 to 3.13"
+#endif
+
+
+/* the interpreter frame layout is only available to the core */
+#define Py_BUILD_CORE 1
+#include <internal/pycore_code.h>
+#include <internal/pycore_frame.h>
+#undef Py_BUILD_CORE
+
+
+#ifndef CO_FAST_HIDDEN
+#define CO_FAST_HIDDEN 0x00
+#endif
+
+
+static inline PyCodeObject *frame_code(PyFrameObject *frame) {
+#if PY_VERSION_HEX >= 0x030D0000
+  return _PyFrame_GetCode(frame->f_frame);
+#else
+  return frame->f_frame->f_code;
+#endif
+}
+
+
+#define frame_lasti(frame) PyFrame_GetLasti(frame)
+#define frame_fast(frame) ((frame)->f_frame->localsplus)
+#define frame_globals(frame) ((frame)->f_frame->f_globals)
+
+/* under 3.13 (PEP 667) optimized frames never have a locals dict */
+#define frame_locals(frame) ((frame)->f_frame->f_locals)
+
+
+#define code_nslots(code) ((code)->co_nlocalsplus)
+
+
+/**
+   The name of slot i, or NULL if the slot is hidden (eg. the
+   iteration variable of an inlined comprehension) and should not be
+   bound by a scope.
+ */
+static inline PyObject *code_slot_name(PyCodeObject *code, Py_ssize_t i) {
+  if (_PyLocals_GetKind(code->co_localspluskinds, i) & CO_FAST_HIDDEN)
+    return NULL;
+  return PyTuple_GET_ITEM(code->co_localsplusnames, i);
+}
+
+
+static inline int code_slot_is_cell(PyCodeObject *code, Py_ssize_t i) {
+  return (_PyLocals_GetKind(code->co_localspluskinds, i) &
+	  (CO_FAST_CELL | CO_FAST_FREE));
+}
+
+
+/**
+   From 3.12 the compiler only checks that a fast local is bound where
+   it can't prove that the local has already been assigned, so a
+   local which was unset and then assigned can't safely be made unset
+   again while the frame is running.
+ */
+#if PY_VERSION_HEX >= 0x030C0000
+#define FAST_UNSET_SAFE 0
+#else
+#define FAST_UNSET_SAFE 1
+#endif
+
+
+#define name_is_uninterned(name)					\
+  (PyUnicode_CheckExact(name) && ! PyUnicode_CHECK_INTERNED(name))
+#define name_intern PyUnicode_InternInPlace
+#if PY_VERSION_HEX >= 0x030C0000 && ! defined(Py_GIL_DISABLED)
+
+#define HAVE_IMMORTAL 1
+
+#ifdef _Py_IMMORTAL_INITIAL_REFCNT
+#define IMMORTAL_REFCNT _Py_IMMORTAL_INITIAL_REFCNT
+#else
+#define IMMORTAL_REFCNT _Py_IMMORTAL_REFCNT
+#endif
+
+
+/**
+   Makes op immortal (PEP 683), so that the interpreter no longer
+   changes its reference count, and it's never freed. As with the
+   interpreter's own _Py_SetImmortal (which isn't exported under
+   3.13), it's also untracked, so that the collector doesn't write to
+   it either.
+ */
+static inline void obj_set_immortal(PyObject *op) {
+  if (PyObject_IS_GC(op) && PyObject_GC_IsTracked(op))
+    PyObject_GC_UnTrack(op);
+  op->ob_refcnt = IMMORTAL_REFCNT;
+}
+
+#endif
+
+
+#else /* PY_MAJOR_VERSION < 3 */
+
+
+#include <cellobject.h>
+
+
+#define frame_code(frame) ((frame)->f_code)
+#define frame_lasti(frame) ((frame)->f_lasti)
+#define frame_fast(frame) ((frame)->f_localsplus)
+#define frame_globals(frame) ((frame)->f_globals)
+#define frame_locals(frame) ((frame)->f_locals)
+
+
+#define code_nslots(code)				\
+  ((code)->co_nlocals +					\
+   PyTuple_GET_SIZE((code)->co_cellvars) +		\
+   PyTuple_GET_SIZE((code)->co_freevars))
+
+
+/**
+   The name of slot i. Fast locals are first, followed by the cell
+   variables, then the free variables.
+ */
+static inline PyObject *code_slot_name(PyCodeObject *code, Py_ssize_t i) {
+  Py_ssize_t ncells;
+
+  if (i < code->co_nlocals)
+    return PyTuple_GET_ITEM(code->co_varnames, i);
+
+  i -= code->co_nlocals;
+  ncells = PyTuple_GET_SIZE(code->co_cellvars);
+
+  if (i < ncells)
+    return PyTuple_GET_ITEM(code->co_cellvars, i);
+  else
+    return PyTuple_GET_ITEM(code->co_freevars, i - ncells);
+}
+
+
+#define code_slot_is_cell(code, i) ((i) >= (code)->co_nlocals)
+
+
+#define name_is_uninterned(name)					\
+  (PyString_CheckExact(name) && ! PyString_CHECK_INTERNED(name))
+#define name_intern PyString_InternInPlace
+
+
+#define FAST_UNSET_SAFE 1
+
+
+#endif /* PY_MAJOR_VERSION */
+
+
+#endif /* WITHSCOPE_FRAME_COMPAT_H */
+
+
+/* The end. */
@@ -0,0 +1,79 @@
+# This library is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as
+# published by the Free Software Foundation; either version 3 of the
+# License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, see
+# <http://www.gnu.org/licenses/>.
+
+
+"""
+Runs a scoped callable over many Scope instances on a pool of
+worker processes.
+
+:author: Christopher O'Brien  <obriencj@gmail.com>
+:license: LGPL v.3
+"""
+
+
+__all__ = ("map_scopes", )
+
+
+from multiprocessing import Pool
+
+
+def _call_scoped(job):
+    # runs in the worker process. The scope arrives as a fresh
+    # unpickled copy, so its post-exit bindings have to be shipped
+    # back alongside the result.
+    func, scope = job
+    result = func(scope)
+    return result, scope.bindings()
+
+
+def map_scopes(func, scopes, processes=None, chunksize=None, pool=None):
+    """
+    Calls `func(scope)` for each Scope in scopes on a pool of worker
+    processes, and returns a list of `(result, bindings)` tuples in
+    the same order as scopes. bindings is a dict of the scope's
+    values after func returned, eg. after func has entered and exited
+    the scope.
+
+    func must be picklable (defined at the top level of a module), as
+    must the values bound in each scope. The scopes themselves are
+    not modified; they are pickled and sent to the workers.
+
+    chunksize is the number of scopes handed to a worker at a time,
+    and is computed by the pool if not specified. An existing
+    `multiprocessing.Pool` may be supplied via pool, in which case it
+    is left running. Otherwise a pool of processes workers is created
+    for the duration of the call.
+    """
+
+    jobs = [(func, scope) for scope in scopes]
+
+    if pool is not None:
+        return pool.map(_call_scoped, jobs, chunksize)
+
+    pool = Pool(processes)
+    try:
+        results = pool.map(_call_scoped, jobs, chunksize)
+    except:
+        pool.terminate()
+        raise
+    else:
+        pool.close()
+    finally:
+        pool.join()
+
+    return results
+
+
+#
+# The end.